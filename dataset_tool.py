@@ -1,10 +1,20 @@
 """Tool for creating multi-resolution TFRecords datasets for StyleGAN and ProGAN."""
 
 import argparse
+import collections
 import glob
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import shutil
 import sys
+import tarfile
 import threading
+import time
 import traceback
+import zipfile
 
 import PIL.Image
 import numpy as np
@@ -13,8 +23,10 @@ import os
 import six.moves.queue as Queue  # pylint: disable=import-error
 import tensorflow as tf
 
+import dnnlib
 import dnnlib.tflib as tflib
 from training import dataset
+from training import records
 #from scipy.misc import imresize
 
 
@@ -29,9 +41,13 @@ def error(msg):
 # ----------------------------------------------------------------------------
 
 
+RESUME_SHARD_MB = 256  # shard size used with resume=True when shard_mb is not given
+
+
 class TFRecordExporter:
     def __init__(
-            self, tfrecord_dir, expected_images, res_log2=7, print_progress=True, progress_interval=10
+            self, tfrecord_dir, expected_images, res_log2=7, print_progress=True, progress_interval=10,
+            shard_mb=0, resume=False, append=False, phash=False, codec="none"
     ):
         self.tfrecord_dir = tfrecord_dir
         self.tfr_prefix = os.path.join(
@@ -42,25 +58,103 @@ class TFRecordExporter:
         self.shape = None
         #self.resolution_log2 = None
         self.res_log2 = res_log2
-        self.tfr_writers = []
+        self.feature = None
+        self.codec = codec  # see records.CODECS, applies to "data" records
+        self._codec_checked = False
+        self.shard_mb = shard_mb  # 0 = write a single tfrecords file
+        if resume and shard_mb == 0:
+            # Progress is only committed when a shard is closed, so a single
+            # file would leave nothing to resume from after a crash.
+            self.shard_mb = RESUME_SHARD_MB
+            print("Resumable runs are written in shards; using --shard_mb=%d" % self.shard_mb)
+        self.shards = []
+        self.tfr_writer = None
+        self.tfr_shard = None
+        self.tfr_index = None
+        self.label_file = None
+        self.label_size = 0
+        self.label_dtype = None
+        self.label_width = 0  # components stored per image: label_size for float, 1 or k for int32
+        self.label_sidecar = self.tfr_prefix + "-rxx.labels.partial"
+        self._label_writer = None
+        self.hash_file = self.tfr_prefix + "-rxx.hashes"
+        self.phash = phash
+        self._hash_writer = None
+        self._known_digests = set()
+        self._known_phashes = set()
         self.print_progress = print_progress
         self.progress_interval = progress_interval
+        self.summary_file = self.tfr_prefix + "-export.json"
+        self._time_read = 0.0  # between add calls: reading, decoding and resizing the inputs
+        self._time_encode = 0.0  # quantizing, hashing, encoding and serializing the records
+        self._time_write = 0.0  # writing the records, closing and checksumming the shards
+        self._bytes_in = 0
+        self._bytes_out = 0
 
         if self.print_progress:
-            print('Creating dataset "%s"' % tfrecord_dir)
+            print('%s dataset "%s"' % ("Appending to" if append else "Creating", tfrecord_dir))
         if not os.path.isdir(self.tfrecord_dir):
             os.makedirs(self.tfrecord_dir)
         assert os.path.isdir(self.tfrecord_dir)
+        if resume or append:
+            self._resume(append)
+        else:
+            self._remove_previous_dataset()
+        if append:
+            self._load_hash_index()
+        for sidecar in [self.label_sidecar, self.hash_file]:
+            if self.cur_images == 0 and os.path.isfile(sidecar):
+                os.remove(sidecar)
+        self._start_images = self.cur_images
+        self._start_time = time.time()
+        self._record_start = self._last_time = self._start_time
 
     def close(self):
         if self.print_progress:
             print("%-40s\r" % "Flushing data...", end="", flush=True)
-        for tfr_writer in self.tfr_writers:
-            tfr_writer.close()
-        self.tfr_writers = []
+        t = time.time()
+        self._close_shard()
+        self._time_write += time.time() - t
+        self._finish_labels()
+        if self.shape is not None:
+            self._save_manifest(complete=True)
+            self._save_summary()
         if self.print_progress:
             print("%-40s\r" % "", end="", flush=True)
-            print("Added %d images." % self.cur_images)
+            print("Added %d images in %d shard(s)." % (self.cur_images, len(self.shards)))
+            summary = self.get_summary()
+            print("%.1f img/s, in %.1f MB/s, out %.1f MB/s; read %s, encode %s, write %s" % (
+                summary["images_per_sec"], summary["input_mb_per_sec"], summary["output_mb_per_sec"],
+                dnnlib.util.format_time(summary["read_sec"]), dnnlib.util.format_time(summary["encode_sec"]),
+                dnnlib.util.format_time(summary["write_sec"])))
+
+    def get_summary(self):  # => dict of throughput figures since this exporter was created
+        seconds = max(time.time() - self._start_time, 1e-6)
+        images = self.cur_images - self._start_images
+        return dict(
+            command=" ".join(sys.argv),
+            images=images,
+            total_images=self.cur_images,
+            seconds=seconds,
+            images_per_sec=images / seconds,
+            input_mb=self._bytes_in / 2**20,
+            output_mb=self._bytes_out / 2**20,
+            input_mb_per_sec=self._bytes_in / 2**20 / seconds,
+            output_mb_per_sec=self._bytes_out / 2**20 / seconds,
+            read_sec=self._time_read,
+            encode_sec=self._time_encode,
+            write_sec=self._time_write,
+            feature=self.feature,
+            codec=self.codec,
+            shape=[int(x) for x in self.shape] if self.shape is not None else None,
+            shard_mb=self.shard_mb,
+            num_shards=len(self.shards),
+        )
+
+    def _save_summary(self):
+        with open(self.summary_file + ".tmp", "w") as f:
+            json.dump(self.get_summary(), f, indent=2)
+        os.replace(self.summary_file + ".tmp", self.summary_file)
 
     def choose_shuffled_order(
             self,
@@ -69,110 +163,376 @@ class TFRecordExporter:
         np.random.RandomState(123).shuffle(order)
         return order
 
-    def add_image_raw(self, encoded_jpg):
+    def _open_shard(self):
+        shard_idx = len(self.shards) if self.shard_mb > 0 or len(self.shards) else None
+        tfr_file = records.shard_filename(self.tfr_prefix, self.res_log2, shard_idx)
+        tfr_opt = tf.python_io.TFRecordOptions(
+            tf.python_io.TFRecordCompressionType.NONE
+        )
+        self.tfr_writer = tf.python_io.TFRecordWriter(tfr_file, tfr_opt)
+        self.tfr_shard = dict(
+            file=os.path.basename(tfr_file),
+            first_record=self.cur_images,
+            num_records=0,
+            num_bytes=0,
+            shape=[int(x) for x in self.shape],
+            index=os.path.basename(records.index_filename(tfr_file)),
+        )
+        self.tfr_index = []
+
+    def _close_shard(self):
+        if self.tfr_writer is None:
+            return
+        self.tfr_writer.close()
+        self.tfr_writer = None
+        tfr_file = os.path.join(self.tfrecord_dir, self.tfr_shard["file"])
+        _fsync_file(tfr_file)
+        index_file = records.index_filename(tfr_file)
+        with open(index_file + ".tmp", "wb") as f:
+            np.save(f, np.array(self.tfr_index, dtype=np.int64).reshape(-1, 2))
+        _fsync_file(index_file + ".tmp")
+        os.replace(index_file + ".tmp", index_file)
+        self.tfr_index = None
+        for sidecar_writer in [self._label_writer, self._hash_writer]:
+            if sidecar_writer is not None:
+                sidecar_writer.flush()
+                os.fsync(sidecar_writer.fileno())
+        self.tfr_shard["num_bytes"] = os.path.getsize(tfr_file)
+        self.tfr_shard["sha1"] = records.file_sha1(tfr_file)
+        self.shards.append(self.tfr_shard)
+        self.tfr_shard = None
+
+    def _checkpoint(self):
+        # Everything in closed shards is durable; record it so that an
+        # interrupted run can pick up from here with resume=True.
+        self._close_shard()
+        if self.shape is not None:
+            self._save_manifest(complete=False)
+
+    def _resume(self, append=False):
+        manifest = records.load_manifest(self.tfrecord_dir)
+        if manifest is None:
+            if append:
+                error("Cannot append: no manifest found in %s" % self.tfrecord_dir)
+            return
+        if append:
+            if manifest["label_size"] > 0:
+                error("Cannot append to a dataset with labels")
+            self.expected_images += manifest["num_records"]
+        elif manifest.get("expected_images") != self.expected_images:
+            error("Cannot resume: dataset was started with %s images, now %d"
+                  % (manifest.get("expected_images"), self.expected_images))
+        if manifest.get("codec", "none") != self.codec:
+            error("Cannot %s: dataset was written with codec %s, not %s"
+                  % ("append" if append else "resume", manifest.get("codec", "none"), self.codec))
+        if not append and manifest["res_log2"] != self.res_log2:
+            error("Cannot resume: dataset was started with res_log2 %d, now %d" % (manifest["res_log2"], self.res_log2))
+        self.res_log2 = manifest["res_log2"]
+        self.shape = manifest["shape"]
+        self.feature = manifest["feature"]
+        self.shards = manifest["shards"]
+        self.cur_images = manifest["num_records"]
+        self.label_file = manifest["label_file"]
+        self.label_size = manifest["label_size"]
+        self.label_dtype = manifest.get("label_dtype")
+        self.label_width = manifest.get("label_width", self.label_size)
+
+        # Drop shards and labels written after the last checkpoint.
+        committed = set(shard["file"] for shard in self.shards)
+        for tfr_file in glob.glob(self.tfr_prefix + "-r*.tfrecords"):
+            if os.path.basename(tfr_file) not in committed:
+                os.remove(tfr_file)
+                if os.path.isfile(records.index_filename(tfr_file)):
+                    os.remove(records.index_filename(tfr_file))
+        if os.path.isfile(self.label_sidecar):
+            row_bytes = self.label_width * np.dtype(self.label_dtype).itemsize
+            with open(self.label_sidecar, "r+b") as f:
+                f.truncate(self.cur_images * row_bytes)
+        if os.path.isfile(self.hash_file):
+            with open(self.hash_file, "r+b") as f:
+                f.truncate(self.cur_images * records.HASH_LINE_BYTES)
+        if self.print_progress:
+            print("Resuming at %d / %d images" % (self.cur_images, self.expected_images))
+
+    def _remove_previous_dataset(self):
+        # A fresh run overwrites the shards; a manifest, index or labels left
+        # from an earlier run would describe bytes that are no longer there.
+        stale = glob.glob(self.tfr_prefix + "-r*.tfrecords") + glob.glob(self.tfr_prefix + "-r*.index")
+        stale += [records.manifest_filename(self.tfr_prefix), self.tfr_prefix + "-rxx.labels"]
+        for stale_file in stale:
+            if os.path.isfile(stale_file):
+                os.remove(stale_file)
+
+    def _load_hash_index(self):
+        if not os.path.isfile(self.hash_file):
+            # Datasets written before the hash index existed: build it once.
+            print("Building hash index for %d existing records..." % self.cur_images)
+            with open(self.hash_file, "wb") as f:
+                for tfr_file in records.get_shard_paths(self.tfrecord_dir, self._manifest_dict()):
+                    for record in tf.python_io.tf_record_iterator(tfr_file):
+                        content = _get_record_content(record, self.codec)
+                        f.write(records.format_hash_line(*self.compute_hashes(content)))
+        for digest, phash in records.load_hash_index(self.hash_file):
+            self._known_digests.add(digest)
+            if phash is not None:
+                self._known_phashes.add(phash)
+        if self.phash and len(self._known_phashes) < len(self._known_digests):
+            print("Warning: some existing records have no perceptual hash")
+
+    def compute_hashes(self, content):  # => (sha1 hex digest, perceptual hash or None)
+        digest = hashlib.sha1(content).hexdigest()
+        phash = None
+        if self.phash:
+            if self.feature == "img":
+                img = PIL.Image.open(io.BytesIO(content))
+            else:
+                img = np.frombuffer(content, np.uint8).reshape(self.shape)
+                img = PIL.Image.fromarray(img[0] if img.shape[0] == 1 else img.transpose(1, 2, 0))
+            phash = _perceptual_hash(img)
+        return digest, phash
+
+    def is_duplicate(self, hashes):
+        digest, phash = hashes
+        return digest in self._known_digests or (phash is not None and phash in self._known_phashes)
+
+    def _add_hashes(self, hashes):
+        digest, phash = hashes
+        self._known_digests.add(digest)
+        if phash is not None:
+            self._known_phashes.add(phash)
+        if self._hash_writer is None:
+            self._hash_writer = open(self.hash_file, "ab")
+        self._hash_writer.write(records.format_hash_line(digest, phash))
+
+    def _write_record(self, serialized):
+        t = time.time()
+        self._time_encode += t - self._record_start
+        if self.tfr_writer is None:
+            self._open_shard()
+        self.tfr_writer.write(serialized)
+        self.tfr_index.append((self.tfr_shard["num_bytes"] + records.RECORD_HEADER_BYTES, len(serialized)))
+        self.tfr_shard["num_records"] += 1
+        self.tfr_shard["num_bytes"] += records.RECORD_HEADER_BYTES + len(serialized) + records.RECORD_FOOTER_BYTES
+        self.cur_images += 1
+        if self.shard_mb > 0 and self.tfr_shard["num_bytes"] >= self.shard_mb << 20:
+            self._checkpoint()
+        self._bytes_out += records.RECORD_HEADER_BYTES + len(serialized) + records.RECORD_FOOTER_BYTES
+        self._last_time = time.time()
+        self._time_write += self._last_time - t
+
+    def _save_manifest(self, complete):
+        manifest = self._manifest_dict()
+        manifest["complete"] = complete
+        records.save_manifest(records.manifest_filename(self.tfr_prefix), manifest)
+
+    def _manifest_dict(self):
+        return dict(
+            version=records.MANIFEST_VERSION,
+            res_log2=self.res_log2,
+            shape=[int(x) for x in self.shape],
+            feature=self.feature,
+            codec=self.codec,
+            num_records=self.cur_images,
+            expected_images=self.expected_images,
+            complete=False,
+            label_file=self.label_file,
+            label_size=self.label_size,
+            label_dtype=self.label_dtype,
+            label_width=self.label_width,
+            hash_file=os.path.basename(self.hash_file),
+            shards=self.shards,
+        )
+
+    def _begin_record(self, input_bytes):
+        # Time since the previous record was written went into producing this one.
+        self._record_start = time.time()
+        self._time_read += self._record_start - self._last_time
+        self._bytes_in += input_bytes
+        self._print_progress()
+
+    def _print_progress(self):
         if self.print_progress and self.cur_images % self.progress_interval == 0:
+            seconds = max(time.time() - self._start_time, 1e-6)
+            rate = (self.cur_images - self._start_images) / seconds
+            eta = (self.expected_images - self.cur_images) / rate if rate > 0 else 0
             print(
-                "%d / %d\r" % (self.cur_images, self.expected_images),
+                "%d / %d  %.1f img/s  in %.1f MB/s  out %.1f MB/s  ETA %s    \r" % (
+                    self.cur_images, self.expected_images, rate, self._bytes_in / 2**20 / seconds,
+                    self._bytes_out / 2**20 / seconds, dnnlib.util.format_time(eta)),
                 end="",
                 flush=True,
             )
-        for lod, tfr_writer in enumerate(self.tfr_writers):
-            ex = tf.train.Example(
-                features=tf.train.Features(
-                    feature={
-                        "shape": tf.train.Feature(
-                            int64_list=tf.train.Int64List(value=self.shape)
-                        ),
-                        "img":tf.train.Feature(bytes_list=tf.train.BytesList(value=[encoded_jpg]))
-                    }
-                )
+
+    def _add_label(self, label):
+        # Labels go to an append-only sidecar next to the records, so that
+        # they are committed together with the shard they belong to.
+        # Integer labels are class indices (padded with -1 for multi-hot),
+        # anything else a dense float32 vector.
+        if label is None:
+            return
+        label = np.asarray(label)
+        if np.issubdtype(label.dtype, np.integer):
+            label = label.astype(np.int32).reshape(-1)
+            self.label_size = max(self.label_size, int(label.max()) + 1)
+        else:
+            label = label.astype(np.float32).reshape(-1)
+            self.label_size = int(label.size)
+        if self.label_dtype is None:
+            self.label_dtype = label.dtype.name
+            self.label_width = int(label.size)
+        assert label.dtype.name == self.label_dtype and label.size == self.label_width
+        if self._label_writer is None:
+            self._label_writer = open(self.label_sidecar, "ab")
+        self._label_writer.write(label.tobytes())
+
+    def _finish_labels(self):
+        if self._label_writer is not None:
+            self._label_writer.close()
+            self._label_writer = None
+        if os.path.isfile(self.label_sidecar):
+            labels = np.fromfile(self.label_sidecar, dtype=self.label_dtype).reshape(-1, self.label_width)
+            if self.label_dtype == "int32" and self.label_width == 1:
+                labels = labels[:, 0]  # plain class indices
+            self.add_labels(labels, self.label_size)
+            os.remove(self.label_sidecar)
+
+    def add_image_raw(self, encoded_jpg, label=None, hashes=None):
+        self._begin_record(len(encoded_jpg))
+        self._add_label(label)
+        self._add_hashes(hashes if hashes is not None else self.compute_hashes(encoded_jpg))
+        ex = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    "shape": tf.train.Feature(
+                        int64_list=tf.train.Int64List(value=self.shape)
+                    ),
+                    "img":tf.train.Feature(bytes_list=tf.train.BytesList(value=[encoded_jpg]))
+                }
             )
-            tfr_writer.write(ex.SerializeToString())
-        self.cur_images += 1
+        )
+        self._write_record(ex.SerializeToString())
         
     def create_tfr_writer(self, shape):
         self.shape = [shape[2], shape[0], shape[1]]
+        self.feature = "img"
         assert self.shape[0] in [1, 3]
         assert self.shape[1] % (2 ** self.res_log2) == 0
         assert self.shape[2] % (2 ** self.res_log2) == 0
-        tfr_opt = tf.python_io.TFRecordOptions(
-            tf.python_io.TFRecordCompressionType.NONE
-        )
-        tfr_file = self.tfr_prefix + "-r%02d.tfrecords" % (
-                    self.res_log2
-        )
-        self.tfr_writers.append(tf.python_io.TFRecordWriter(tfr_file, tfr_opt))
 
-
-    def add_image(self, img):
-        if self.print_progress and self.cur_images % self.progress_interval == 0:
-            print(
-                "%d / %d\r" % (self.cur_images, self.expected_images),
-                end="",
-                flush=True,
-            )
+    def add_image(self, img, label=None, encoded=None, input_bytes=None):
+        # encoded: the quantized img already passed through records.encode_pixels()
+        # with this exporter's codec, e.g. by a worker process.
+        # input_bytes: size of the source the image was read from, if any; by
+        # default the image counts as its uint8 pixels, e.g. for in-memory arrays.
+        self._begin_record(input_bytes if input_bytes is not None else np.size(img))
+        self._add_label(label)
         if self.shape is None:
             self.shape = img.shape
+            self.feature = "data"
             #self.resolution_log2 = int(np.log2(self.shape[1]))
             assert self.shape[0] in [1, 3]
             #assert self.shape[1] == self.shape[2]
             #assert self.shape[1] == 2 ** self.resolution_log2
             assert self.shape[1] % (2 ** self.res_log2) == 0
             assert self.shape[2] % (2 ** self.res_log2) == 0
-            tfr_opt = tf.python_io.TFRecordOptions(
-                tf.python_io.TFRecordCompressionType.NONE
-            )
-            tfr_file = self.tfr_prefix + "-r%02d.tfrecords" % (
-                        self.res_log2
-                )
-            self.tfr_writers.append(tf.python_io.TFRecordWriter(tfr_file, tfr_opt))
-            """
-            for lod in range(self.resolution_log2 - 1):
-                tfr_file = self.tfr_prefix + "-r%02d.tfrecords" % (
-                        self.resolution_log2 - lod
-                )
-                self.tfr_writers.append(tf.python_io.TFRecordWriter(tfr_file, tfr_opt))
-            """
-        assert img.shape == self.shape
-        for lod, tfr_writer in enumerate(self.tfr_writers):
-            if lod:
-                img = img.astype(np.float32)
-                img = (
-                              img[:, 0::2, 0::2]
-                              + img[:, 0::2, 1::2]
-                              + img[:, 1::2, 0::2]
-                              + img[:, 1::2, 1::2]
-                      ) * 0.25
-            quant = np.rint(img).clip(0, 255).astype(np.uint8)
-            ex = tf.train.Example(
-                features=tf.train.Features(
-                    feature={
-                        "shape": tf.train.Feature(
-                            int64_list=tf.train.Int64List(value=quant.shape)
-                        ),
-                        "data": tf.train.Feature(
-                            bytes_list=tf.train.BytesList(value=[quant.tostring()])
-                        ),
-                    }
-                )
+        assert list(img.shape) == list(self.shape)
+        quant = img if img.dtype == np.uint8 else np.rint(img).clip(0, 255).astype(np.uint8)
+        self._add_hashes(self.compute_hashes(quant.tostring()))
+        if encoded is None:
+            encoded = records.encode_pixels(quant, self.codec)
+        if not self._codec_checked:
+            self._check_codec(quant, encoded)
+        ex = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    "shape": tf.train.Feature(
+                        int64_list=tf.train.Int64List(value=quant.shape)
+                    ),
+                    "data": tf.train.Feature(
+                        bytes_list=tf.train.BytesList(value=[encoded])
+                    ),
+                }
             )
-            tfr_writer.write(ex.SerializeToString())
-        self.cur_images += 1
-
-    def add_labels(self, labels):
+        )
+        self._write_record(ex.SerializeToString())
+
+    def add_record(self, serialized, hashes, label=None):
+        # Copy a serialized record as is, e.g. from another dataset with the
+        # same shape, feature and codec; self.shape and self.feature must be set.
+        self._begin_record(len(serialized))
+        self._add_label(label)
+        self._add_hashes(hashes)
+        self._write_record(serialized)
+
+    def _check_codec(self, quant, encoded):
+        # The codecs are lossless; make sure the first image of a run decodes to exactly the same pixels.
+        try:
+            ok = np.array_equal(records.decode_pixels(encoded, quant.shape, self.codec), quant)
+        except ValueError:  # decoded to a different number of pixels
+            ok = False
+        if not ok:
+            error("Codec %s does not reproduce %s images of shape %s" % (self.codec, self.feature, list(quant.shape)))
+        self._codec_checked = True
+
+    def add_labels(self, labels, label_size=None):
+        # Integer labels are stored compactly as int32 class indices [N], or
+        # as [N, k] lists of class indices padded with -1 for multi-hot labels;
+        # training.dataset expands them per minibatch. label_size defaults to
+        # the largest class index + 1. Float labels are stored dense [N, label_size].
         if self.print_progress:
             print("%-40s\r" % "Saving labels...", end="", flush=True)
+        labels = np.asarray(labels)
         assert labels.shape[0] == self.cur_images
-        with open(self.tfr_prefix + "-rxx.labels", "wb") as f:
-            np.save(f, labels.astype(np.float32))
+        if np.issubdtype(labels.dtype, np.integer):
+            assert labels.ndim in [1, 2]
+            labels = labels.astype(np.int32)
+            self.label_size = int(label_size if label_size is not None else labels.max() + 1)
+        else:
+            assert labels.ndim == 2
+            labels = labels.astype(np.float32)
+            self.label_size = int(labels.shape[1])
+        label_file = self.tfr_prefix + "-rxx.labels"
+        with open(label_file, "wb") as f:
+            np.save(f, labels)
+        self.label_file = os.path.basename(label_file)
+        self.label_dtype = labels.dtype.name
+        self.label_width = 1 if labels.ndim == 1 else int(labels.shape[1])
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *args):
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:  # keep what was written so far resumable
+            self._checkpoint()
+            for sidecar_writer in [self._label_writer, self._hash_writer]:
+                if sidecar_writer is not None:
+                    sidecar_writer.close()
+            return
         self.close()
 
 
+def _fsync_file(filename):
+    with open(filename, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _get_record_content(record, codec):  # => encoded image bytes or raw pixel bytes
+    ex = tf.train.Example()
+    ex.ParseFromString(record)
+    if "img" in ex.features.feature:
+        return ex.features.feature["img"].bytes_list.value[0]
+    data = ex.features.feature["data"].bytes_list.value[0]
+    shape = ex.features.feature["shape"].int64_list.value
+    return records.decode_pixels(data, shape, codec).tobytes()
+
+
+def _perceptual_hash(img):  # => 64-bit difference hash as hex string
+    img.draft("L", (64, 64))  # let the JPEG decoder downscale in the DCT domain
+    pixels = np.asarray(img.convert("L").resize((9, 8), PIL.Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return "%016x" % int("".join("1" if bit else "0" for bit in bits), 2)
+
+
 # ----------------------------------------------------------------------------
 
 
@@ -281,19 +641,11 @@ class ThreadPool(object):
 
 def display(tfrecord_dir):
     print('Loading dataset "%s"' % tfrecord_dir)
-    tflib.init_tf({"gpu_options.allow_growth": True})
-    dset = dataset.TFRecordDataset(
-        tfrecord_dir, max_label_size="full", repeat=False, shuffle_mb=0
-    )
-    tflib.init_uninitialized_vars()
+    reader = records.NumpyReader(tfrecord_dir, max_label_size="full", num_workers=0)
     import cv2  # pip install opencv-python
 
     idx = 0
-    while True:
-        try:
-            images, labels = dset.get_minibatch_np(1)
-        except tf.errors.OutOfRangeError:
-            break
+    for images, labels in reader.iterate_minibatches(1):
         if idx == 0:
             print("Displaying images")
             cv2.namedWindow("dataset_tool")
@@ -311,49 +663,74 @@ def display(tfrecord_dir):
 # ----------------------------------------------------------------------------
 
 
-def extract(tfrecord_dir, output_dir):
+def _extract_image(args):  # => 1 if the stored bytes were written verbatim, else 0
+    idx, output_dir, raw, codec = args
+    record = _worker_source.read(idx)
+    if raw:
+        features = records.parse_example(record)
+        if "img" in features:
+            data = features["img"][0]
+            fmt = PIL.Image.open(io.BytesIO(data)).format  # parses the header only
+            ext = {"JPEG": "jpg", "TIFF": "tif"}.get(fmt, str(fmt).lower())
+            with open(os.path.join(output_dir, "img%08d.%s" % (idx, ext)), "wb") as f:
+                f.write(data)
+            return 1
+    img = records.decode_record(record, codec=codec)
+    if img.shape[0] == 1:
+        img = PIL.Image.fromarray(img[0], "L")
+    else:
+        img = PIL.Image.fromarray(img.transpose(1, 2, 0), "RGB")
+    img.save(os.path.join(output_dir, "img%08d.png" % idx))
+    return 0
+
+
+def extract(tfrecord_dir, output_dir, raw=1, workers=1):
     print('Loading dataset "%s"' % tfrecord_dir)
-    tflib.init_tf({"gpu_options.allow_growth": True})
-    dset = dataset.TFRecordDataset(
-        tfrecord_dir, max_label_size=0, repeat=False, shuffle_mb=0
-    )
-    tflib.init_uninitialized_vars()
+    reader, manifest = records.open_record_reader(tfrecord_dir)
+    codec = manifest.get("codec", "none") if manifest is not None else "none"
 
     print('Extracting images to "%s"' % output_dir)
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
-    idx = 0
-    while True:
-        if idx % 10 == 0:
+    tasks = ((idx, output_dir, raw, codec) for idx in range(len(reader)))
+    num_raw = 0
+    for idx, was_raw in enumerate(_imap_ordered(_extract_image, tasks, workers, reader, chunksize=64)):
+        if idx % 100 == 0:
             print("%d\r" % idx, end="", flush=True)
-        try:
-            images, _labels = dset.get_minibatch_np(1)
-        except tf.errors.OutOfRangeError:
-            break
-        if images.shape[1] == 1:
-            img = PIL.Image.fromarray(images[0][0], "L")
-        else:
-            img = PIL.Image.fromarray(images[0].transpose(1, 2, 0), "RGB")
-        img.save(os.path.join(output_dir, "img%08d.png" % idx))
-        idx += 1
-    print("Extracted %d images." % idx)
+        num_raw += was_raw
+    print("Extracted %d images (%d stored, %d encoded as PNG)." % (len(reader), num_raw, len(reader) - num_raw))
 
 
 # ----------------------------------------------------------------------------
 
 
-def compare(tfrecord_dir_a, tfrecord_dir_b, ignore_labels):
+def _record_digest(record):  # => SHA-1 of the image shape and stored bytes
+    features = records.parse_example(record)
+    payload = features["data"][0] if "data" in features else features["img"][0]
+    return hashlib.sha1(np.asarray(features["shape"], np.int64).tobytes() + payload).digest()
+
+
+def _compare_records(idx):  # => 0 if stored bytes match, 1 if only the decoded pixels match, 2 if different
+    (reader_a, codec_a), (reader_b, codec_b) = _worker_source
+    record_a = reader_a.read(idx)
+    record_b = reader_b.read(idx)
+    if codec_a == codec_b and _record_digest(record_a) == _record_digest(record_b):
+        return 0
+    img_a = records.decode_record(record_a, codec=codec_a)
+    img_b = records.decode_record(record_b, codec=codec_b)
+    return 1 if img_a.shape == img_b.shape and np.all(img_a == img_b) else 2
+
+
+def compare(tfrecord_dir_a, tfrecord_dir_b, ignore_labels, fast=0, workers=1, max_report=10):
+    if fast:
+        return _compare_fast(tfrecord_dir_a, tfrecord_dir_b, ignore_labels, workers, max_report)
     max_label_size = 0 if ignore_labels else "full"
     print('Loading dataset "%s"' % tfrecord_dir_a)
-    tflib.init_tf({"gpu_options.allow_growth": True})
-    dset_a = dataset.TFRecordDataset(
-        tfrecord_dir_a, max_label_size=max_label_size, repeat=False, shuffle_mb=0
-    )
+    reader_a = records.NumpyReader(tfrecord_dir_a, max_label_size=max_label_size)
     print('Loading dataset "%s"' % tfrecord_dir_b)
-    dset_b = dataset.TFRecordDataset(
-        tfrecord_dir_b, max_label_size=max_label_size, repeat=False, shuffle_mb=0
-    )
-    tflib.init_uninitialized_vars()
+    reader_b = records.NumpyReader(tfrecord_dir_b, max_label_size=max_label_size)
+    minibatches_a = reader_a.iterate_minibatches(1)
+    minibatches_b = reader_b.iterate_minibatches(1)
 
     print("Comparing datasets")
     idx = 0
@@ -362,14 +739,8 @@ def compare(tfrecord_dir_a, tfrecord_dir_b, ignore_labels):
     while True:
         if idx % 100 == 0:
             print("%d\r" % idx, end="", flush=True)
-        try:
-            images_a, labels_a = dset_a.get_minibatch_np(1)
-        except tf.errors.OutOfRangeError:
-            images_a, labels_a = None, None
-        try:
-            images_b, labels_b = dset_b.get_minibatch_np(1)
-        except tf.errors.OutOfRangeError:
-            images_b, labels_b = None, None
+        images_a, labels_a = next(minibatches_a, (None, None))
+        images_b, labels_b = next(minibatches_b, (None, None))
         if images_a is None or images_b is None:
             if images_a is not None or images_b is not None:
                 print("Datasets contain different number of images")
@@ -388,6 +759,326 @@ def compare(tfrecord_dir_a, tfrecord_dir_b, ignore_labels):
         print("Identical labels: %d / %d" % (identical_labels, idx))
 
 
+
+def _compare_fast(tfrecord_dir_a, tfrecord_dir_b, ignore_labels, workers, max_report):
+    # Compare digests of the stored records and decode only the records whose digests differ.
+    max_label_size = 0 if ignore_labels else "full"
+    print('Loading dataset "%s"' % tfrecord_dir_a)
+    reader_a = records.NumpyReader(tfrecord_dir_a, max_label_size=max_label_size)
+    print('Loading dataset "%s"' % tfrecord_dir_b)
+    reader_b = records.NumpyReader(tfrecord_dir_b, max_label_size=max_label_size)
+    if reader_a.num_images != reader_b.num_images:
+        print("Datasets contain different number of images")
+    num_images = min(reader_a.num_images, reader_b.num_images)
+    source = [(records.open_record_reader(reader.tfrecord_dir)[0], reader.codec) for reader in [reader_a, reader_b]]
+
+    print("Comparing datasets")
+    counts = [0, 0, 0]
+    for idx, status in enumerate(_imap_ordered(_compare_records, range(num_images), workers, source, chunksize=256)):
+        if idx % 1000 == 0:
+            print("%d\r" % idx, end="", flush=True)
+        counts[status] += 1
+        if status == 2 and counts[2] <= max_report:
+            print("Image %d is different" % idx)
+    if counts[2] > max_report:
+        print("... and %d more different images" % (counts[2] - max_report))
+    print("Identical images: %d / %d (%d with identical stored bytes)" % (counts[0] + counts[1], num_images, counts[0]))
+    if not ignore_labels:
+        labels_a = reader_a.get_labels_np(0, num_images)
+        labels_b = reader_b.get_labels_np(0, num_images)
+        if labels_a.shape == labels_b.shape:
+            different = np.flatnonzero(np.any(labels_a != labels_b, axis=1))
+        else:
+            different = np.arange(num_images)
+        for idx in different[:max_report]:
+            print("Label %d is different" % idx)
+        if len(different) > max_report:
+            print("... and %d more different labels" % (len(different) - max_report))
+        print("Identical labels: %d / %d" % (num_images - len(different), num_images))
+
+# ----------------------------------------------------------------------------
+
+
+class _SourceDataset:
+    # Serialized records of an existing dataset, with their labels and content hashes.
+    def __init__(self, tfrecord_dir):
+        self.tfrecord_dir = tfrecord_dir
+        self.reader, manifest = records.open_record_reader(tfrecord_dir)
+        self.num_images = len(self.reader)
+        features = records.parse_example(self.reader.read(0))
+        self.shape = [int(x) for x in features["shape"]]
+        self.feature = "img" if "img" in features else "data"
+        label_file, label_size = None, None
+        self.hashes = None
+        if manifest is not None:
+            self.res_log2 = manifest["res_log2"]
+            self.codec = manifest.get("codec", "none")
+            if manifest["label_file"] is not None:
+                label_file = os.path.join(tfrecord_dir, manifest["label_file"])
+                label_size = manifest["label_size"]
+            hash_file = os.path.join(tfrecord_dir, manifest.get("hash_file") or "")
+            if os.path.isfile(hash_file) and os.path.getsize(hash_file) >= self.num_images * records.HASH_LINE_BYTES:
+                self.hashes = records.load_hash_index(hash_file)[:self.num_images]
+        else:
+            self.res_log2 = int(self.reader.tfr_files[0].split("-r")[-1].split(".")[0])
+            self.codec = "none"
+        self.labels, self.label_size = records.load_labels(
+            records.find_label_file(tfrecord_dir, label_file), "full", label_size)
+
+    def get_hashes(self, idx):  # => (digest, phash or None)
+        if self.hashes is not None:
+            return self.hashes[idx]
+        return hashlib.sha1(_get_record_content(self.reader.read(idx), self.codec)).hexdigest(), None
+
+    def has_classes(self, idx, classes):  # => True if the label of image idx sets any of the classes
+        if self.labels.dtype == np.int32:
+            return bool(np.isin(self.labels[idx], classes).any())
+        return bool((self.labels[idx][[c for c in classes if c < self.label_size]] > 0).any())
+
+
+def _copy_records(tfr, source, indices, dedup=False):  # => number of records skipped as duplicates
+    if tfr.shape is None:
+        tfr.shape = source.shape
+        tfr.feature = source.feature
+    if [list(tfr.shape), tfr.feature, tfr.codec] != [source.shape, source.feature, source.codec]:
+        error('Dataset "%s" stores %s %s records of shape %s, expected %s %s records of shape %s' % (
+            source.tfrecord_dir, source.codec, source.feature, source.shape, tfr.codec, tfr.feature, list(tfr.shape)))
+    if source.labels is not None:
+        tfr.label_size = max(tfr.label_size, source.label_size)
+    skipped = 0
+    for idx in indices:
+        hashes = source.get_hashes(idx)
+        if dedup and tfr.is_duplicate(hashes):
+            skipped += 1
+            continue
+        label = source.labels[idx] if source.labels is not None else None
+        tfr.add_record(source.reader.read(idx), hashes, label)
+    return skipped
+
+
+def _parse_index_list(indices):  # => int64 array from "1,5,7" or a .npy / text file of indices
+    if os.path.isfile(indices):
+        if indices.endswith(".npy"):
+            return np.load(indices).astype(np.int64).reshape(-1)
+        return np.loadtxt(indices, dtype=np.int64).reshape(-1)
+    return np.array(_parse_int_list(indices), dtype=np.int64)
+
+
+def subset(tfrecord_dir, source_dir, indices=None, num_images=None, labels=None, seed=123, shard_mb=0):
+    # Copy the selected records and their labels without decoding any image.
+    # The label filter is applied first, then the index list, then the random sample.
+    source = _SourceDataset(source_dir)
+    selected = np.arange(source.num_images)
+    if labels is not None:
+        if source.labels is None:
+            error('Dataset "%s" has no labels to filter by' % source_dir)
+        classes = _parse_int_list(labels)
+        selected = np.array([idx for idx in selected if source.has_classes(idx, classes)], dtype=np.int64)
+    if indices is not None:
+        index_list = _parse_index_list(indices)
+        if len(index_list) and (index_list.min() < 0 or index_list.max() >= source.num_images):
+            error("Indices must be in [0, %d)" % source.num_images)
+        selected = index_list[np.isin(index_list, selected)]
+    if num_images is not None and num_images < len(selected):
+        selected = np.sort(np.random.RandomState(seed).choice(selected, num_images, replace=False))
+    if not len(selected):
+        error("No images selected")
+
+    print('Selected %d of %d images from "%s"' % (len(selected), source.num_images, source_dir))
+    with TFRecordExporter(tfrecord_dir, len(selected), res_log2=source.res_log2, shard_mb=shard_mb,
+                          codec=source.codec) as tfr:
+        _copy_records(tfr, source, selected)
+
+
+def merge(tfrecord_dir, source_dirs, dedup=0, shard_mb=0):
+    # Concatenate datasets of the same shape, feature and codec without decoding any image.
+    sources = [_SourceDataset(source_dir) for source_dir in source_dirs]
+    if len(set(source.labels is None for source in sources)) > 1:
+        error("Either all or none of the datasets must have labels")
+    label_layouts = set((source.labels.dtype.name,) + source.labels.shape[1:] for source in sources if source.labels is not None)
+    if len(label_layouts) > 1:
+        error("All labels must be stored the same way, found %s" % ", ".join(map(str, sorted(label_layouts))))
+    if len(set(source.res_log2 for source in sources)) > 1:
+        error("All datasets must have the same res_log2")
+    expected_images = sum(source.num_images for source in sources)
+    with TFRecordExporter(tfrecord_dir, expected_images, res_log2=sources[0].res_log2, shard_mb=shard_mb,
+                          codec=sources[0].codec) as tfr:
+        for source in sources:
+            print('Copying %d images from "%s"' % (source.num_images, source.tfrecord_dir))
+            skipped = _copy_records(tfr, source, range(source.num_images), dedup=bool(dedup))
+            if skipped:
+                print("Skipped %d duplicate images" % skipped)
+
+
+def create_stats(tfrecord_dir, features=1, max_images=None, mirror=0, minibatch_size=32, workers=None):
+    # Pixel and record-size statistics over all images, plus an optional bank
+    # of Inception features that FID reads instead of running Inception over the reals.
+    print('Loading dataset "%s"' % tfrecord_dir)
+    reader = records.NumpyReader(tfrecord_dir, num_workers=workers)
+    manifest_file = records.find_manifest(tfrecord_dir)
+    if manifest_file is not None:
+        tfr_prefix = manifest_file[:-len("-manifest.json")]
+    else:
+        tfr_prefix = os.path.join(tfrecord_dir, os.path.basename(os.path.normpath(tfrecord_dir)))
+    num_features = min(max_images or reader.num_images, reader.num_images) if features else 0
+
+    inception = None
+    if num_features:
+        from metrics import frechet_inception_distance  # pylint: disable=import-outside-toplevel
+        from training import misc  # pylint: disable=import-outside-toplevel
+        tflib.init_tf({"gpu_options.allow_growth": True})
+        inception = misc.load_pkl(frechet_inception_distance.INCEPTION_URL)
+        bank_file = tfr_prefix + "-inception.npy"
+        mirror_file = tfr_prefix + "-inception-mirror.npy" if mirror else None
+        banks = [np.lib.format.open_memmap(f, mode="w+", dtype=np.float32, shape=(num_features, inception.output_shape[1]))
+                 for f in [bank_file, mirror_file] if f is not None]
+
+    print("Computing statistics for %d images (Inception features for %d)" % (reader.num_images, num_features))
+    channels = reader.shape[0]
+    pixel_sum = np.zeros(channels, np.float64)
+    pixel_sqr_sum = np.zeros(channels, np.float64)
+    pixel_hist = np.zeros([channels, 256], np.int64)
+    begin = 0
+    for images, _labels in reader.iterate_minibatches(minibatch_size):
+        print("%d / %d\r" % (begin, reader.num_images), end="", flush=True)
+        pixels = images.transpose(1, 0, 2, 3).reshape(channels, -1)
+        pixel_sum += pixels.sum(axis=1, dtype=np.float64)
+        pixel_sqr_sum += np.square(pixels, dtype=np.float64).sum(axis=1)
+        for c in range(channels):
+            pixel_hist[c] += np.bincount(pixels[c], minlength=256)
+        end = min(begin + len(images), num_features)
+        if begin < end:
+            banks[0][begin:end] = inception.run(images[:end - begin], assume_frozen=True)
+            if mirror:
+                banks[1][begin:end] = inception.run(images[:end - begin, :, :, ::-1], assume_frozen=True)
+        begin += len(images)
+    num_pixels = float(reader.num_images) * reader.shape[1] * reader.shape[2]
+    mean = pixel_sum / num_pixels
+    std = np.sqrt(np.maximum(pixel_sqr_sum / num_pixels - np.square(mean), 0))
+    counts, edges = np.histogram(records.open_record_reader(tfrecord_dir)[0].record_lengths(), bins=32)
+
+    stats = dict(
+        num_images=reader.num_images,
+        dataset=records.dataset_fingerprint(tfrecord_dir),
+        shape=reader.shape,
+        mean=mean.tolist(),
+        std=std.tolist(),
+        pixel_histogram=pixel_hist.tolist(),
+        record_bytes=dict(edges=edges.tolist(), counts=counts.tolist()),
+        inception=None,
+    )
+    if num_features:
+        for bank in banks:
+            bank.flush()
+        stats["inception"] = dict(
+            network=frechet_inception_distance.INCEPTION_URL,
+            num_images=num_features,
+            file=os.path.basename(bank_file),
+            mirror_file=os.path.basename(mirror_file) if mirror else None,
+        )
+    stats_file = records.stats_filename(tfr_prefix)
+    with open(stats_file + ".tmp", "w") as f:
+        json.dump(stats, f, indent=2)
+    os.replace(stats_file + ".tmp", stats_file)
+    print("Mean %s, std %s" % (" ".join("%.2f" % x for x in mean), " ".join("%.2f" % x for x in std)))
+    print('Wrote "%s"' % stats_file)
+
+
+def bench_codecs(tfrecord_dir, codecs=",".join(records.CODECS), num_images=256):
+    # Stored size against encode and decode speed of each codec, on the first images of a dataset.
+    reader = records.NumpyReader(tfrecord_dir, num_workers=0)
+    num_images = min(num_images, reader.num_images)
+    images, _labels = next(reader.iterate_minibatches(num_images))
+    print('Benchmarking codecs on %d images of "%s", %s' % (num_images, tfrecord_dir, "x".join(map(str, reader.shape))))
+    print("%-6s %-7s %-9s %-10s %-13s %-13s" % ("codec", "ratio", "KB/image", "enc MB/s", "np dec img/s", "tf dec img/s"))
+    for codec in codecs.split(","):
+        try:
+            t0 = time.time()
+            encoded = [records.encode_pixels(img, codec) for img in images]
+            t1 = time.time()
+        except ImportError as e:
+            print("%-6s skipped: %s" % (codec, e))
+            continue
+        for data in encoded:
+            records.decode_pixels(data, reader.shape, codec)
+        t2 = time.time()
+
+        # Single-threaded decode through the training input pipeline.
+        serialized = [tf.train.Example(features=tf.train.Features(feature={
+            "shape": tf.train.Feature(int64_list=tf.train.Int64List(value=reader.shape)),
+            "data": tf.train.Feature(bytes_list=tf.train.BytesList(value=[data])),
+        })).SerializeToString() for data in encoded]
+        with tf.Graph().as_default(), tflib.create_session().as_default():
+            dset = tf.data.Dataset.from_tensor_slices(serialized).repeat(2)
+            dset = dset.map(lambda record: dataset.parse_tfrecord_tf(record, codec=codec)).batch(num_images)
+            images_op = dset.make_one_shot_iterator().get_next()
+            tflib.run(images_op)  # warm up
+            t3 = time.time()
+            tflib.run(images_op)
+            t4 = time.time()
+
+        num_bytes = sum(len(data) for data in encoded)
+        print("%-6s %-7.2f %-9.1f %-10.1f %-13.1f %-13.1f" % (
+            codec, images.nbytes / num_bytes, num_bytes / num_images / 1024, images.nbytes / (t1 - t0) / 2**20,
+            num_images / (t2 - t1), num_images / (t4 - t3)))
+
+
+def _parse_int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+def bench(tfrecord_dir, minibatch_size="32", num_threads="0", prefetch_mb="2048", shuffle_mb="4096",
+          num_batches=200, warmup=20, random_access=0, decode_scale=1):
+    # Drive the input pipeline alone, without any network, for every combination of the given parameters.
+    configs = [
+        (mb, nt, pm, sm)
+        for mb in _parse_int_list(minibatch_size)
+        for nt in _parse_int_list(num_threads)
+        for pm in _parse_int_list(prefetch_mb)
+        for sm in _parse_int_list(shuffle_mb)
+    ]
+    manifest = records.load_manifest(tfrecord_dir)
+    print('Benchmarking dataset "%s" with %d configuration(s), %d minibatches each'
+          % (tfrecord_dir, len(configs), num_batches))
+    print("%-9s %-8s %-11s %-10s %-10s %-10s %-11s %-9s %-9s" % (
+        "minibatch", "threads", "prefetch_mb", "shuffle_mb", "img/s", "MB/s", "disk MB/s", "p50 ms", "p99 ms"))
+    results = []
+    for mb, nt, pm, sm in configs:
+        with tf.Graph().as_default(), tflib.create_session({"gpu_options.allow_growth": True}).as_default():
+            dset = dataset.TFRecordDataset(
+                tfrecord_dir, repeat=True, shuffle_mb=sm, prefetch_mb=pm, num_threads=nt,
+                random_access=bool(random_access), decode_scale=decode_scale,
+            )
+            tflib.init_uninitialized_vars()
+            images, _labels = dset.get_minibatch_tf()
+            num_images_op = tf.shape(images)[0]  # forces the whole minibatch through the pipeline
+            dset.configure(mb)
+            for _ in range(warmup):
+                tflib.run(num_images_op)
+            latencies = []
+            num_images = 0
+            start = time.time()
+            for _ in range(num_batches):
+                t = time.time()
+                num_images += tflib.run(num_images_op)
+                latencies.append(time.time() - t)
+            total_time = time.time() - start
+            dset.close()
+        img_per_sec = num_images / total_time
+        mb_per_sec = img_per_sec * np.prod(dset.shape) / 2 ** 20
+        disk_mb_per_sec = float("nan")
+        if manifest is not None and manifest["num_records"] > 0:
+            bytes_per_record = sum(shard["num_bytes"] for shard in manifest["shards"]) / manifest["num_records"]
+            disk_mb_per_sec = img_per_sec * bytes_per_record / 2 ** 20
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print("%-9d %-8s %-11d %-10d %-10.1f %-10.1f %-11.1f %-9.1f %-9.1f" % (
+            mb, nt if nt > 0 else "auto", pm, sm, img_per_sec, mb_per_sec, disk_mb_per_sec, p50, p99))
+        results.append((img_per_sec, mb, nt, pm, sm))
+    if len(results) > 1:
+        best = max(results)
+        print("Fastest: %.1f img/s with minibatch_size=%d num_threads=%d prefetch_mb=%d shuffle_mb=%d" % best)
+
+
 # ----------------------------------------------------------------------------
 
 
@@ -407,14 +1098,12 @@ def create_mnist(tfrecord_dir, mnist_dir):
     assert labels.shape == (60000,) and labels.dtype == np.uint8
     assert np.min(images) == 0 and np.max(images) == 255
     assert np.min(labels) == 0 and np.max(labels) == 9
-    onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
-    onehot[np.arange(labels.size), labels] = 1.0
 
     with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
         order = tfr.choose_shuffled_order()
         for idx in range(order.size):
             tfr.add_image(images[order[idx]])
-        tfr.add_labels(onehot[order])
+        tfr.add_labels(labels[order])
 
 
 # ----------------------------------------------------------------------------
@@ -457,14 +1146,12 @@ def create_cifar10(tfrecord_dir, cifar10_dir):
     assert labels.shape == (50000,) and labels.dtype == np.int32
     assert np.min(images) == 0 and np.max(images) == 255
     assert np.min(labels) == 0 and np.max(labels) == 9
-    onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
-    onehot[np.arange(labels.size), labels] = 1.0
 
     with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
         order = tfr.choose_shuffled_order()
         for idx in range(order.size):
             tfr.add_image(images[order[idx]])
-        tfr.add_labels(onehot[order])
+        tfr.add_labels(labels[order])
 
 
 # ----------------------------------------------------------------------------
@@ -482,14 +1169,12 @@ def create_cifar100(tfrecord_dir, cifar100_dir):
     assert labels.shape == (50000,) and labels.dtype == np.int32
     assert np.min(images) == 0 and np.max(images) == 255
     assert np.min(labels) == 0 and np.max(labels) == 99
-    onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
-    onehot[np.arange(labels.size), labels] = 1.0
 
     with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
         order = tfr.choose_shuffled_order()
         for idx in range(order.size):
             tfr.add_image(images[order[idx]])
-        tfr.add_labels(onehot[order])
+        tfr.add_labels(labels[order])
 
 
 # ----------------------------------------------------------------------------
@@ -512,103 +1197,108 @@ def create_svhn(tfrecord_dir, svhn_dir):
     assert labels.shape == (73257,) and labels.dtype == np.uint8
     assert np.min(images) == 0 and np.max(images) == 255
     assert np.min(labels) == 0 and np.max(labels) == 9
-    onehot = np.zeros((labels.size, np.max(labels) + 1), dtype=np.float32)
-    onehot[np.arange(labels.size), labels] = 1.0
 
     with TFRecordExporter(tfrecord_dir, images.shape[0]) as tfr:
         order = tfr.choose_shuffled_order()
         for idx in range(order.size):
             tfr.add_image(images[order[idx]])
-        tfr.add_labels(onehot[order])
+        tfr.add_labels(labels[order])
 
 
 # ----------------------------------------------------------------------------
 
 
-def create_lsun(tfrecord_dir, lmdb_dir, resolution=256, max_images=None):
-    print('Loading LSUN dataset from "%s"' % lmdb_dir)
-    import lmdb  # pip install lmdb # pylint: disable=import-error
+def _decode_lsun_image(value):  # => HWC RGB array
     import cv2  # pip install opencv-python
-    import io
-
-    with lmdb.open(lmdb_dir, readonly=True).begin(write=False) as txn:
-        total_images = txn.stat()["entries"]  # pylint: disable=no-value-for-parameter
-        if max_images is None:
-            max_images = total_images
-        with TFRecordExporter(tfrecord_dir, max_images) as tfr:
-            for _idx, (_key, value) in enumerate(txn.cursor()):
-                try:
-                    try:
-                        img = cv2.imdecode(np.fromstring(value, dtype=np.uint8), 1)
-                        if img is None:
-                            raise IOError("cv2.imdecode failed")
-                        img = img[:, :, ::-1]  # BGR => RGB
-                    except IOError:
-                        img = np.asarray(PIL.Image.open(io.BytesIO(value)))
-                    crop = np.min(img.shape[:2])
-                    img = img[
-                          (img.shape[0] - crop) // 2: (img.shape[0] + crop) // 2,
-                          (img.shape[1] - crop) // 2: (img.shape[1] + crop) // 2,
-                          ]
-                    img = PIL.Image.fromarray(img, "RGB")
-                    img = img.resize((resolution, resolution), PIL.Image.ANTIALIAS)
-                    img = np.asarray(img)
-                    img = img.transpose([2, 0, 1])  # HWC => CHW
-                    tfr.add_image(img)
-                except:
-                    print(sys.exc_info()[1])
-                if tfr.cur_images == max_images:
-                    break
+
+    try:
+        img = cv2.imdecode(np.frombuffer(value, dtype=np.uint8), 1)
+        if img is None:
+            raise IOError("cv2.imdecode failed")
+        return img[:, :, ::-1]  # BGR => RGB
+    except IOError:
+        return np.asarray(PIL.Image.open(io.BytesIO(value)))
+
+
+def _load_lsun_image(args):  # => CHW array, or error message
+    idx, resolution = args
+    try:
+        img = _decode_lsun_image(_worker_source.read(idx))
+        crop = np.min(img.shape[:2])
+        img = img[
+              (img.shape[0] - crop) // 2: (img.shape[0] + crop) // 2,
+              (img.shape[1] - crop) // 2: (img.shape[1] + crop) // 2,
+              ]
+        img = PIL.Image.fromarray(img, "RGB")
+        img = img.resize((resolution, resolution), PIL.Image.LANCZOS)
+        img = np.asarray(img)
+        return img.transpose([2, 0, 1])  # HWC => CHW
+    except Exception as e:  # pylint: disable=broad-except
+        return str(e)
+
+
+def _load_lsun_wide_image(args):  # => CHW array, None if too small, or error message
+    idx, width, height = args
+    try:
+        img = _decode_lsun_image(_worker_source.read(idx))
+        ch = int(np.round(width * img.shape[0] / img.shape[1]))
+        if img.shape[1] < width or ch < height:
+            return None
+
+        img = img[(img.shape[0] - ch) // 2: (img.shape[0] + ch) // 2]
+        img = PIL.Image.fromarray(img, "RGB")
+        img = img.resize((width, height), PIL.Image.LANCZOS)
+        img = np.asarray(img)
+        img = img.transpose([2, 0, 1])  # HWC => CHW
+
+        canvas = np.zeros([3, width, width], dtype=np.uint8)
+        canvas[:, (width - height) // 2: (width + height) // 2] = img
+        return canvas
+    except Exception as e:  # pylint: disable=broad-except
+        return str(e)
+
+
+def create_lsun(tfrecord_dir, lmdb_dir, resolution=256, max_images=None, workers=1):
+    print('Loading LSUN dataset from "%s"' % lmdb_dir)
+    source = LmdbSource(lmdb_dir)
+    total_images = len(source.names)
+    if max_images is None:
+        max_images = total_images
+    with TFRecordExporter(tfrecord_dir, max_images) as tfr:
+        tasks = ((idx, resolution) for idx in range(total_images))
+        for img in _imap_ordered(_load_lsun_image, tasks, workers, source, chunksize=64):
+            if isinstance(img, str):
+                print(img)
+                continue
+            tfr.add_image(img)
+            if tfr.cur_images == max_images:
+                break
 
 
 # ----------------------------------------------------------------------------
 
 
-def create_lsun_wide(tfrecord_dir, lmdb_dir, width=512, height=384, max_images=None):
+def create_lsun_wide(tfrecord_dir, lmdb_dir, width=512, height=384, max_images=None, workers=1):
     assert width == 2 ** int(np.round(np.log2(width)))
     assert height <= width
     print('Loading LSUN dataset from "%s"' % lmdb_dir)
-    import lmdb  # pip install lmdb # pylint: disable=import-error
-    import cv2  # pip install opencv-python
-    import io
-
-    with lmdb.open(lmdb_dir, readonly=True).begin(write=False) as txn:
-        total_images = txn.stat()["entries"]  # pylint: disable=no-value-for-parameter
-        if max_images is None:
-            max_images = total_images
-        with TFRecordExporter(tfrecord_dir, max_images, print_progress=False) as tfr:
-            for idx, (_key, value) in enumerate(txn.cursor()):
-                try:
-                    try:
-                        img = cv2.imdecode(np.fromstring(value, dtype=np.uint8), 1)
-                        if img is None:
-                            raise IOError("cv2.imdecode failed")
-                        img = img[:, :, ::-1]  # BGR => RGB
-                    except IOError:
-                        img = np.asarray(PIL.Image.open(io.BytesIO(value)))
-
-                    ch = int(np.round(width * img.shape[0] / img.shape[1]))
-                    if img.shape[1] < width or ch < height:
-                        continue
-
-                    img = img[(img.shape[0] - ch) // 2: (img.shape[0] + ch) // 2]
-                    img = PIL.Image.fromarray(img, "RGB")
-                    img = img.resize((width, height), PIL.Image.ANTIALIAS)
-                    img = np.asarray(img)
-                    img = img.transpose([2, 0, 1])  # HWC => CHW
-
-                    canvas = np.zeros([3, width, width], dtype=np.uint8)
-                    canvas[:, (width - height) // 2: (width + height) // 2] = img
-                    tfr.add_image(canvas)
-                    print(
-                        "\r%d / %d => %d " % (idx + 1, total_images, tfr.cur_images),
-                        end="",
-                    )
-
-                except:
-                    print(sys.exc_info()[1])
-                if tfr.cur_images == max_images:
-                    break
+    source = LmdbSource(lmdb_dir)
+    total_images = len(source.names)
+    if max_images is None:
+        max_images = total_images
+    with TFRecordExporter(tfrecord_dir, max_images, print_progress=False) as tfr:
+        tasks = ((idx, width, height) for idx in range(total_images))
+        for idx, img in enumerate(_imap_ordered(_load_lsun_wide_image, tasks, workers, source, chunksize=64)):
+            if isinstance(img, str):
+                print(img)
+            elif img is not None:
+                tfr.add_image(img)
+                print(
+                    "\r%d / %d => %d " % (idx + 1, total_images, tfr.cur_images),
+                    end="",
+                )
+            if tfr.cur_images == max_images:
+                break
     print()
 
 
@@ -647,13 +1337,307 @@ def _get_all_files(path):
     return return_list
 
 
-def create_from_images(tfrecord_dir, image_dir, shuffle, res_log2=7, resize=None):
-    print('Loading images from "%s"' % image_dir)
-    image_filenames = _get_all_files(image_dir)
-    print(f"detected {len(image_filenames)} images ...")
-    if len(image_filenames) == 0:
+# ----------------------------------------------------------------------------
+# Sources of encoded image files, addressed by index so that they can be read
+# in shuffled order: a directory tree, or a tar/zip archive read in place.
+
+
+class ImageSource:
+    names = []
+
+    def read(self, idx):  # => encoded bytes of the idx'th image
+        raise NotImplementedError
+
+    def open_stream(self, idx):  # => seekable file object, for reading just the header
+        raise NotImplementedError
+
+    def open(self, idx):
+        return PIL.Image.open(io.BytesIO(self.read(idx)))
+
+    def select(self, indices):  # keep only the given images, in the given order
+        self.names = [self.names[idx] for idx in indices]
+
+
+class DirectorySource(ImageSource):
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        self.names = _get_all_files(image_dir)
+
+    def read(self, idx):
+        with tf.gfile.FastGFile(self.names[idx], "rb") as fid:
+            return fid.read()
+
+    def open_stream(self, idx):
+        return tf.gfile.GFile(self.names[idx], "rb")
+
+
+class ArchiveSource(ImageSource):
+    image_extensions = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.is_zip = zipfile.is_zipfile(archive_path)
+        self.is_compressed = False  # random access into a compressed tar re-decompresses from the start
+        if not self.is_zip:
+            try:
+                tarfile.open(archive_path, "r:").close()
+            except tarfile.ReadError:
+                self.is_compressed = True
+        self._archive = None
+        self._archive_pid = None
+        if self.is_zip:
+            members = self._get_archive().infolist()
+            self._members = [m for m in members if not m.is_dir() and self._is_image(m.filename)]
+            self.names = [m.filename for m in self._members]
+        else:
+            members = self._get_archive().getmembers()
+            self._members = [m for m in members if m.isfile() and self._is_image(m.name)]
+            self.names = [m.name for m in self._members]
+        order = sorted(range(len(self.names)), key=lambda i: self.names[i])
+        self._members = [self._members[i] for i in order]
+        self.names = [self.names[i] for i in order]
+
+    def _is_image(self, name):
+        return name.lower().endswith(self.image_extensions) and "/__MACOSX/" not in "/" + name
+
+    def _get_archive(self):
+        if self._archive is None or self._archive_pid != os.getpid():  # one file handle per worker process
+            self._archive = zipfile.ZipFile(self.archive_path) if self.is_zip else tarfile.open(self.archive_path)
+            self._archive_pid = os.getpid()
+        return self._archive
+
+    def read(self, idx):
+        if self.is_zip:
+            return self._get_archive().read(self._members[idx])
+        return self._get_archive().extractfile(self._members[idx]).read()
+
+    def open_stream(self, idx):
+        if self.is_zip:
+            return self._get_archive().open(self._members[idx])
+        return self._get_archive().extractfile(self._members[idx])
+
+    def select(self, indices):
+        self._members = [self._members[idx] for idx in indices]
+        self.names = [self.names[idx] for idx in indices]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_archive"] = None
+        return state
+
+
+class LmdbSource(ImageSource):
+    # Images stored as values of an LMDB database, as in the LSUN release.
+    # Every worker process opens its own read-only environment and transaction.
+
+    def __init__(self, lmdb_dir):
+        self.lmdb_dir = lmdb_dir
+        self._env = None
+        self._txn = None
+        self._txn_pid = None
+        self.names = list(self._get_txn().cursor().iternext(keys=True, values=False))
+        self.close()  # an environment must not be inherited by forked workers
+
+    def close(self):
+        if self._env is not None:
+            self._txn.abort()
+            self._env.close()
+        self._env = None
+        self._txn = None
+
+    def _get_txn(self):
+        if self._txn is None or self._txn_pid != os.getpid():
+            import lmdb  # pip install lmdb # pylint: disable=import-error
+
+            self._env = lmdb.open(self.lmdb_dir, readonly=True, lock=False)
+            self._txn = self._env.begin(write=False)
+            self._txn_pid = os.getpid()
+        return self._txn
+
+    def read(self, idx):
+        return self._get_txn().get(self.names[idx])
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_env"] = None
+        state["_txn"] = None
+        return state
+
+
+def _open_image_source(path):
+    if os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path)):
+        return ArchiveSource(path)
+    return DirectorySource(path)
+
+
+def _open_image_source_for_order(path, shuffle):
+    print('Loading images from "%s"' % path)
+    source = _open_image_source(path)
+    print(f"detected {len(source.names)} images ...")
+    if len(source.names) == 0:
         error("No input images found")
-    img = np.asarray(PIL.Image.open(image_filenames[0]))
+    if shuffle and isinstance(source, ArchiveSource) and source.is_compressed:
+        error("Shuffled ingestion needs random access: use an uncompressed .tar or a .zip archive, or --shuffle 0")
+    return source
+
+
+# ----------------------------------------------------------------------------
+
+_worker_source = None
+
+
+def _init_worker_source(source):
+    global _worker_source  # pylint: disable=global-statement
+    _worker_source = source
+
+
+def _read_image_header(idx):  # => ((width, height), mode, format) or (None, None, error message)
+    try:
+        with _worker_source.open_stream(idx) as stream:
+            img = PIL.Image.open(stream)  # parses the header, pixel data is not decoded
+            return img.size, img.mode, img.format
+    except Exception as e:  # pylint: disable=broad-except
+        return None, None, str(e)
+
+
+def _validate_image_headers(source, res_log2, workers, quarantine_dir=None):
+    # Check size, mode and format of every image against the most common
+    # combination, and drop the mismatches from the source.
+    print("Validating %d image headers using %d worker(s) ..." % (len(source.names), workers))
+    indices = list(range(len(source.names)))
+    headers = list(_imap_ordered(_read_image_header, indices, workers, source, chunksize=64))
+    valid = [header for header in headers if header[0] is not None]
+    if len(valid) == 0:
+        error("No readable input images found")
+    values, counts = np.unique(np.array([repr(header) for header in valid]), return_counts=True)
+    ref_size, ref_mode, ref_format = [h for h in valid if repr(h) == values[np.argmax(counts)]][0]
+    if ref_mode not in ["RGB", "L"]:
+        error("Input images must be stored as RGB or grayscale")
+    if ref_size[0] % (2 ** res_log2) != 0 or ref_size[1] % (2 ** res_log2) != 0:
+        error("Image width and height must be multiples of %d, got %dx%d" % (2 ** res_log2, ref_size[0], ref_size[1]))
+
+    rejected = []
+    for idx, (size, mode, fmt) in enumerate(headers):
+        if size is None:
+            rejected.append((idx, "unreadable: %s" % fmt))
+        elif size != ref_size:
+            rejected.append((idx, "size %dx%d, expected %dx%d" % (size + ref_size)))
+        elif mode != ref_mode:
+            rejected.append((idx, "mode %s, expected %s" % (mode, ref_mode)))
+        elif fmt != ref_format:
+            rejected.append((idx, "format %s, expected %s" % (fmt, ref_format)))
+    print("Reference: %dx%d %s %s, %d image(s) rejected" % (ref_size + (ref_mode, ref_format, len(rejected))))
+    for idx, reason in rejected[:20]:
+        print("  %s: %s" % (source.names[idx], reason))
+    if len(rejected) > 20:
+        print("  ...")
+
+    if quarantine_dir is not None and len(rejected):
+        os.makedirs(quarantine_dir, exist_ok=True)
+        with open(os.path.join(quarantine_dir, "rejected.txt"), "a") as f:
+            for idx, reason in rejected:
+                f.write("%s\t%s\n" % (source.names[idx], reason))
+        if isinstance(source, DirectorySource):
+            for idx, _reason in rejected:
+                # Keep the path below the image root: labelled datasets reuse file names across class folders.
+                dst = os.path.join(quarantine_dir, os.path.relpath(source.names[idx], source.image_dir))
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                base, ext = os.path.splitext(dst)
+                suffix = 1
+                while os.path.exists(dst):  # never overwrite an earlier quarantined file
+                    dst = "%s.%d%s" % (base, suffix, ext)
+                    suffix += 1
+                shutil.move(source.names[idx], dst)
+        print('Quarantined %d image(s) in "%s"' % (len(rejected), quarantine_dir))
+    rejected_idx = set(idx for idx, _reason in rejected)
+    source.select([idx for idx in indices if idx not in rejected_idx])
+    if len(source.names) == 0:
+        error("No valid input images found")
+
+
+def _resize_image(img, size):
+    # Crop to the aspect ratio of the target and resize to it. For JPEG input,
+    # draft mode lets the decoder scale by 1/2, 1/4 or 1/8 in the DCT domain
+    # first, so only the final step is done with the (slower) Lanczos filter.
+    width, height = size
+    scale = max(width / img.size[0], height / img.size[1])
+    img.draft(img.mode, (int(np.ceil(img.size[0] * scale)), int(np.ceil(img.size[1] * scale))))
+    crop_w = min(img.size[0], int(round(img.size[1] * width / height)))
+    crop_h = min(img.size[1], int(round(img.size[0] * height / width)))
+    left = (img.size[0] - crop_w) // 2
+    top = (img.size[1] - crop_h) // 2
+    img = img.crop((left, top, left + crop_w, top + crop_h))
+    return img.resize((width, height), PIL.Image.LANCZOS)
+
+
+def _load_image_chw(args):
+    idx, size = args
+    return _to_chw(_worker_source.open(idx), size)
+
+
+def _to_chw(img, size):  # PIL image => CHW array, resized to size if given
+    if size is not None:
+        img = _resize_image(img, size)
+    img = np.asarray(img)
+    if img.ndim == 2:
+        img = img[np.newaxis, :, :]  # HW => CHW
+    else:
+        img = img.transpose([2, 0, 1])  # HWC => CHW
+    if img.shape[0] > 3:
+        img = img[:3, ...]
+    return img
+
+
+def _load_encoded_image_chw(args):  # => CHW array, its encoding with the given codec, size of the source file
+    idx, size, codec = args
+    data = _worker_source.read(idx)
+    img = _to_chw(PIL.Image.open(io.BytesIO(data)), size)
+    return img, records.encode_pixels(img, codec), len(data)
+
+
+def _apply_chunk(args):
+    func, chunk = args
+    return [func(item) for item in chunk]
+
+
+def _imap_ordered(func, items, workers, source, chunksize=16):
+    # Apply func to items in a pool of worker processes, yielding results in input order.
+    # Each worker gets its own copy of the image source. Only a few chunks per
+    # worker are in flight, so a slow consumer does not buffer unbounded results.
+    if workers <= 1:
+        _init_worker_source(source)
+        for item in items:
+            yield func(item)
+        return
+    with multiprocessing.Pool(workers, _init_worker_source, (source,)) as pool:
+        pending = collections.deque()
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, chunksize))
+            if len(chunk):
+                pending.append(pool.apply_async(_apply_chunk, ((func, chunk),)))
+            if len(pending) and (len(pending) >= 4 * workers or not len(chunk)):
+                for result in pending.popleft().get():
+                    yield result
+            elif not len(chunk):
+                break
+
+
+def _get_target_size(res_log2, resize, min_h, min_w):  # => (width, height) or None
+    if min_h is not None or min_w is not None:
+        if min_h is None or min_w is None:
+            error("--min_h and --min_w must be given together")
+        return (min_w * 2 ** res_log2, min_h * 2 ** res_log2)
+    if resize is not None:
+        return (2 ** resize, 2 ** resize)
+    return None
+
+
+def create_from_images(tfrecord_dir, image_dir, shuffle, res_log2=7, resize=None, workers=1, shard_mb=0, resume=0,
+                       min_h=None, min_w=None, codec="none"):
+    source = _open_image_source_for_order(image_dir, shuffle)
+    size = _get_target_size(res_log2, resize, min_h, min_w)
+    img = np.asarray(source.open(0))
     #resolution = img.shape[0]
     channels = img.shape[2] if img.ndim == 3 else 1
     """
@@ -666,32 +1650,24 @@ def create_from_images(tfrecord_dir, image_dir, shuffle, res_log2=7, resize=None
     if channels not in [1, 3]:
         error("Input images must be stored as RGB or grayscale")
 
-    with TFRecordExporter(tfrecord_dir, len(image_filenames)) as tfr:
+    with TFRecordExporter(tfrecord_dir, len(source.names), res_log2=res_log2, shard_mb=shard_mb, resume=resume,
+                          codec=codec) as tfr:
         order = (
-            tfr.choose_shuffled_order() if shuffle else np.arange(len(image_filenames))
+            tfr.choose_shuffled_order() if shuffle else np.arange(len(source.names))
         )
-        print("Adding the images to tfrecords ...")
-        for idx in range(order.size):
-            img = np.asarray(PIL.Image.open(image_filenames[order[idx]]))
-            if resize is not None:
-                size = int(2 ** resize)
-                #img = imresize(img, (size, size))
-                img = np.array(Image.fromarray(img).resize((size, size))) 
-            if channels == 1:
-                img = img[np.newaxis, :, :]  # HW => CHW
-            else:
-                img = img.transpose([2, 0, 1])  # HWC => CHW
-            if img.shape[0] > 3:
-                img = img[:3, ...]
-            tfr.add_image(img)
-
-def create_from_images_raw(tfrecord_dir, image_dir, shuffle, res_log2=7, resize=None):
-    print('Loading images from "%s"' % image_dir)
-    image_filenames = _get_all_files(image_dir)
-    print(f"detected {len(image_filenames)} images ...")
-    if len(image_filenames) == 0:
-        error("No input images found")
-    img = np.asarray(PIL.Image.open(image_filenames[0]))
+        print("Adding the images to tfrecords using %d worker(s) ..." % workers)
+        if size is not None:
+            print("Resizing the images to %dx%d ..." % size)
+        tasks = [(idx, size, codec) for idx in order[tfr.cur_images:]]
+        for img, encoded, input_bytes in _imap_ordered(_load_encoded_image_chw, tasks, workers, source):
+            tfr.add_image(img, encoded=encoded, input_bytes=input_bytes)
+
+def create_from_images_raw(tfrecord_dir, image_dir, shuffle, res_log2=7, resize=None, shard_mb=0, resume=0,
+                           validate=1, workers=1, quarantine_dir=None):
+    source = _open_image_source_for_order(image_dir, shuffle)
+    if validate:
+        _validate_image_headers(source, res_log2, workers, quarantine_dir)
+    img = np.asarray(source.open(0))
     #resolution = img.shape[0]
     channels = img.shape[2] if img.ndim == 3 else 1
     
@@ -699,27 +1675,22 @@ def create_from_images_raw(tfrecord_dir, image_dir, shuffle, res_log2=7, resize=
         error("Input images must be stored as RGB or grayscale")
     if shuffle:
         print("Shuffle the images...")
-    with TFRecordExporter(tfrecord_dir, len(image_filenames)) as tfr:
+    with TFRecordExporter(tfrecord_dir, len(source.names), res_log2=res_log2, shard_mb=shard_mb, resume=resume) as tfr:
         order = (
-            tfr.choose_shuffled_order() if shuffle else np.arange(len(image_filenames))
+            tfr.choose_shuffled_order() if shuffle else np.arange(len(source.names))
         )
         tfr.create_tfr_writer(img.shape)
         print("Adding the images to tfrecords ...")
-        for idx in range(order.size):
-            if idx % 1000 == 0:
-                print ("added images", idx)
-            with tf.gfile.FastGFile(image_filenames[order[idx]], 'rb') as fid:
-                encoded_jpg = fid.read()
-                tfr.add_image_raw(encoded_jpg)
+        for idx in range(tfr.cur_images, order.size):
+            tfr.add_image_raw(source.read(order[idx]))
 # ----------------------------------------------------------------------------
 
-def create_from_images_raw_with_labels(tfrecord_dir, image_dir, shuffle, res_log2=7, labels=68, resize=None):
-    print('Loading images from "%s"' % image_dir)
-    image_filenames = _get_all_files(image_dir)
-    print(f"detected {len(image_filenames)} images ...")
-    if len(image_filenames) == 0:
-        error("No input images found")
-    img = np.asarray(PIL.Image.open(image_filenames[0]))
+def create_from_images_raw_with_labels(tfrecord_dir, image_dir, shuffle, res_log2=7, labels=68, resize=None, shard_mb=0, resume=0,
+                                       validate=1, workers=1, quarantine_dir=None):
+    source = _open_image_source_for_order(image_dir, shuffle)
+    if validate:
+        _validate_image_headers(source, res_log2, workers, quarantine_dir)
+    img = np.asarray(source.open(0))
     #resolution = img.shape[0]
     channels = img.shape[2] if img.ndim == 3 else 1
     
@@ -728,24 +1699,81 @@ def create_from_images_raw_with_labels(tfrecord_dir, image_dir, shuffle, res_log
     if shuffle:
         print("Shuffle the images...")
 
-    onehot = np.zeros((len(image_filenames), labels), dtype=np.float32)
-    print(onehot.shape)
-
-    with TFRecordExporter(tfrecord_dir, len(image_filenames)) as tfr:
+    with TFRecordExporter(tfrecord_dir, len(source.names), res_log2=res_log2, shard_mb=shard_mb, resume=resume) as tfr:
         order = (
-            tfr.choose_shuffled_order() if shuffle else np.arange(len(image_filenames))
+            tfr.choose_shuffled_order() if shuffle else np.arange(len(source.names))
         )
         tfr.create_tfr_writer(img.shape)
+        tfr.label_size = max(tfr.label_size, labels)
         print("Adding the images to tfrecords ...")
-        for idx in range(order.size):
-            label = image_filenames[order[idx]].split('/')[2]
-            onehot[idx,int(label)-1] = 1.0
-            if idx % 1000 == 0:
-                print ("added images", idx)
-            with tf.gfile.FastGFile(image_filenames[order[idx]], 'rb') as fid:
-                encoded_jpg = fid.read()
-                tfr.add_image_raw(encoded_jpg)
-        tfr.add_labels(onehot[order])
+        for idx in range(tfr.cur_images, order.size):
+            label = source.names[order[idx]].split('/')[2]
+            tfr.add_image_raw(source.read(order[idx]), label=int(label)-1)
+# ----------------------------------------------------------------------------
+
+
+def append(tfrecord_dir, image_dir, shuffle, shard_mb=0, phash=0):
+    source = _open_image_source_for_order(image_dir, shuffle)
+
+    with TFRecordExporter(tfrecord_dir, len(source.names), shard_mb=shard_mb, append=True, phash=phash) as tfr:
+        if tfr.feature != "img":
+            error("Only datasets created with create_from_images_raw can be appended to")
+        old_images = tfr.cur_images
+        order = np.arange(len(source.names))
+        if shuffle:
+            np.random.RandomState(123).shuffle(order)
+        num_duplicates = 0
+        for idx in order:
+            encoded_jpg = source.read(idx)
+            img = PIL.Image.open(io.BytesIO(encoded_jpg))  # reads the header only
+            shape = [len(img.getbands()), img.size[1], img.size[0]]
+            if shape != list(tfr.shape):
+                print("Skipping %s: shape %s does not match %s" % (source.names[idx], shape, list(tfr.shape)))
+                continue
+            hashes = tfr.compute_hashes(encoded_jpg)
+            if tfr.is_duplicate(hashes):
+                num_duplicates += 1
+                continue
+            tfr.add_image_raw(encoded_jpg, hashes=hashes)
+        print("Appended %d images, skipped %d duplicates." % (tfr.cur_images - old_images, num_duplicates))
+
+# ----------------------------------------------------------------------------
+
+
+def create_mmap(dataset_dir, image_dir, shuffle, res_log2=7, resize=None, workers=1, min_h=None, min_w=None):
+    # Decode every image once into a single [N, C, H, W] uint8 array, read by training.dataset.MmapDataset.
+    source = _open_image_source_for_order(image_dir, shuffle)
+    size = _get_target_size(res_log2, resize, min_h, min_w)
+    _init_worker_source(source)
+    shape = _load_image_chw((0, size)).shape
+    if shape[0] not in [1, 3]:
+        error("Input images must be stored as RGB or grayscale")
+    if shape[1] % 2 ** res_log2 or shape[2] % 2 ** res_log2:
+        error("Image width and height must be multiples of 2**res_log2, use --resize or --min_h/--min_w")
+
+    num_images = len(source.names)
+    order = np.arange(num_images)
+    if shuffle:
+        np.random.RandomState(123).shuffle(order)
+    if not os.path.isdir(dataset_dir):
+        os.makedirs(dataset_dir)
+    prefix = os.path.join(dataset_dir, os.path.basename(dataset_dir))
+    images_file = prefix + "-images.npy"
+    print("Writing %d images of shape %s to %s using %d worker(s) ..." % (num_images, list(shape), images_file, workers))
+    images = np.lib.format.open_memmap(images_file + ".tmp", mode="w+", dtype=np.uint8, shape=(num_images,) + shape)
+    tasks = [(idx, size) for idx in order]
+    for dst_idx, img in enumerate(_imap_ordered(_load_image_chw, tasks, workers, source)):
+        if img.shape != shape:
+            error("Image %s has shape %s, expected %s" % (source.names[order[dst_idx]], list(img.shape), list(shape)))
+        images[dst_idx] = img
+        if dst_idx % 1000 == 0:
+            print("%d / %d\r" % (dst_idx, num_images), end="", flush=True)
+    images.flush()
+    del images
+    _fsync_file(images_file + ".tmp")
+    os.replace(images_file + ".tmp", images_file)
+    print("Added %d images." % num_images)
+
 # ----------------------------------------------------------------------------
 
 
@@ -797,6 +1825,18 @@ def execute_cmdline(argv):
     )
     p.add_argument("tfrecord_dir", help="Directory containing dataset")
     p.add_argument("output_dir", help="Directory to extract the images into")
+    p.add_argument(
+        "--raw",
+        help="Write encoded images in their stored format instead of PNG (default: 1)",
+        type=int,
+        default=1
+    )
+    p.add_argument(
+        "--workers",
+        help="Number of processes used to decode and write the images (default: 1)",
+        type=int,
+        default=1
+    )
 
     p = add_command(
         "compare", "Compare two datasets.", "compare datasets/mydataset datasets/mnist"
@@ -806,6 +1846,140 @@ def execute_cmdline(argv):
     p.add_argument(
         "--ignore_labels", help="Ignore labels (default: 0)", type=int, default=0
     )
+    p.add_argument(
+        "--fast",
+        help="Compare digests of the stored records, decoding only the ones that differ (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--workers",
+        help="Number of processes reading and hashing records with --fast (default: 1)",
+        type=int,
+        default=1
+    )
+    p.add_argument(
+        "--max_report",
+        help="Number of differing images and labels to list with --fast (default: 10)",
+        type=int,
+        default=10
+    )
+
+    p = add_command(
+        "subset",
+        "Copy selected records and their labels to a new dataset, without decoding.",
+        "subset datasets/mysubset datasets/mydataset --num_images=10000",
+    )
+    p.add_argument("tfrecord_dir", help="New dataset directory to be created")
+    p.add_argument("source_dir", help="Directory containing the dataset to copy from")
+    p.add_argument(
+        "--indices", help="Comma-separated indices, or a .npy or text file of indices (default: all)", default=None
+    )
+    p.add_argument(
+        "--num_images", help="Random sample of this many images (default: all)", type=int, default=None
+    )
+    p.add_argument(
+        "--labels", help="Comma-separated classes; keep images labelled with any of them (default: all)", default=None
+    )
+    p.add_argument("--seed", help="Random seed for --num_images (default: 123)", type=int, default=123)
+    p.add_argument(
+        "--shard_mb",
+        help="Split the dataset into tfrecords shards of about this size, 0 = single file (default: 0)",
+        type=int,
+        default=0
+    )
+
+    p = add_command(
+        "merge",
+        "Concatenate datasets and their labels into a new dataset, without decoding.",
+        "merge datasets/merged datasets/scrape1 datasets/scrape2 --dedup=1",
+    )
+    p.add_argument("tfrecord_dir", help="New dataset directory to be created")
+    p.add_argument("source_dirs", help="Directories containing the datasets to merge", nargs="+")
+    p.add_argument(
+        "--dedup", help="Skip images whose content hash was already copied (default: 0)", type=int, default=0
+    )
+    p.add_argument(
+        "--shard_mb",
+        help="Split the dataset into tfrecords shards of about this size, 0 = single file (default: 0)",
+        type=int,
+        default=0
+    )
+
+    p = add_command(
+        "bench",
+        "Measure input pipeline throughput without a network. Comma-separated values are swept.",
+        "bench datasets/mydataset --num_threads=1,2,4,0 --prefetch_mb=256,2048",
+    )
+    p.add_argument("tfrecord_dir", help="Directory containing the dataset")
+    p.add_argument(
+        "--minibatch_size", help="Minibatch size(s) (default: 32)", default="32"
+    )
+    p.add_argument(
+        "--num_threads", help="Decode thread count(s), 0 = autotune (default: 0)", default="0"
+    )
+    p.add_argument(
+        "--prefetch_mb", help="Prefetch buffer size(s) in MB (default: 2048)", default="2048"
+    )
+    p.add_argument(
+        "--shuffle_mb", help="Shuffle buffer size(s) in MB (default: 4096)", default="4096"
+    )
+    p.add_argument(
+        "--num_batches", help="Minibatches timed per configuration (default: 200)", type=int, default=200
+    )
+    p.add_argument(
+        "--warmup", help="Minibatches run before timing, to fill the buffers (default: 20)", type=int, default=20
+    )
+    p.add_argument(
+        "--random_access", help="Read records in a random permutation (default: 0)", type=int, default=0
+    )
+    p.add_argument(
+        "--decode_scale", help="Decode images downscaled by 1, 2, 4 or 8 (default: 1)", type=int, default=1
+    )
+
+    p = add_command(
+        "bench_codecs",
+        "Compare stored size and decode speed of the per-record codecs.",
+        "bench_codecs datasets/mydataset --codecs=none,zlib,png",
+    )
+    p.add_argument("tfrecord_dir", help="Directory containing the dataset")
+    p.add_argument(
+        "--codecs", help="Comma-separated codecs (default: all)", default=",".join(records.CODECS)
+    )
+    p.add_argument(
+        "--num_images", help="Number of images to encode and decode (default: 256)", type=int, default=256
+    )
+
+    p = add_command(
+        "create_stats",
+        "Compute dataset statistics and a bank of Inception features used by FID.",
+        "create_stats datasets/mydataset --max_images=50000 --mirror=1",
+    )
+    p.add_argument("tfrecord_dir", help="Directory containing the dataset")
+    p.add_argument(
+        "--features", help="Compute Inception features of the reals (default: 1)", type=int, default=1
+    )
+    p.add_argument(
+        "--max_images",
+        help="Compute features for the first N images only (default: all)",
+        type=int,
+        default=None,
+    )
+    p.add_argument(
+        "--mirror",
+        help="Also compute features of the mirrored images, for runs with --mirror-augment (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--minibatch_size", help="Images per Inception minibatch (default: 32)", type=int, default=32
+    )
+    p.add_argument(
+        "--workers",
+        help="Number of processes used to decode the images (default: one per CPU)",
+        type=int,
+        default=None
+    )
 
     p = add_command(
         "create_mnist",
@@ -872,6 +2046,12 @@ def execute_cmdline(argv):
         type=int,
         default=None,
     )
+    p.add_argument(
+        "--workers",
+        help="Number of processes decoding and resizing LMDB records (default: 1)",
+        type=int,
+        default=1
+    )
 
     p = add_command(
         "create_lsun_wide",
@@ -890,6 +2070,12 @@ def execute_cmdline(argv):
         type=int,
         default=None,
     )
+    p.add_argument(
+        "--workers",
+        help="Number of processes decoding and resizing LMDB records (default: 1)",
+        type=int,
+        default=1
+    )
 
     p = add_command(
         "create_celeba",
@@ -912,7 +2098,7 @@ def execute_cmdline(argv):
         "create_from_images datasets/mydataset myimagedir",
     )
     p.add_argument("tfrecord_dir", help="New dataset directory to be created")
-    p.add_argument("image_dir", help="Directory containing the images")
+    p.add_argument("image_dir", help="Directory or .tar/.zip archive containing the images")
     p.add_argument(
         "--resize",
         help="resize to given power of 2 sized square images (default: None)",
@@ -929,6 +2115,42 @@ def execute_cmdline(argv):
         type=int,
         default=7
     )
+    p.add_argument(
+        "--shard_mb",
+        help="Split the dataset into tfrecords shards of about this size, 0 = single file (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--resume",
+        help="Continue an interrupted run from its last completed shard; implies --shard_mb=256 if unset (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--workers",
+        help="Number of processes used to decode and resize images (default: 1)",
+        type=int,
+        default=1
+    )
+    p.add_argument(
+        "--min_h",
+        help="Center-crop and resize to a height of min_h * 2**res_log2 (default: None)",
+        type=int,
+        default=None
+    )
+    p.add_argument(
+        "--min_w",
+        help="Center-crop and resize to a width of min_w * 2**res_log2 (default: None)",
+        type=int,
+        default=None
+    )
+    p.add_argument(
+        "--codec",
+        help="Lossless per-record compression, see bench_codecs (default: none)",
+        choices=records.CODECS,
+        default="none"
+    )
     
     p = add_command(
         "create_from_images_raw",
@@ -937,7 +2159,7 @@ def execute_cmdline(argv):
         "create_from_images_raw datasets/mydataset myimagedir",
     )
     p.add_argument("tfrecord_dir", help="New dataset directory to be created")
-    p.add_argument("image_dir", help="Directory containing the images")
+    p.add_argument("image_dir", help="Directory or .tar/.zip archive containing the images")
     p.add_argument(
         "--resize",
         help="resize to given power of 2 sized square images (default: None)",
@@ -954,6 +2176,35 @@ def execute_cmdline(argv):
         type=int,
         default=7
     )
+    p.add_argument(
+        "--shard_mb",
+        help="Split the dataset into tfrecords shards of about this size, 0 = single file (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--resume",
+        help="Continue an interrupted run from its last completed shard; implies --shard_mb=256 if unset (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--validate",
+        help="Check the header of every image and skip mismatching ones before adding (default: 1)",
+        type=int,
+        default=1
+    )
+    p.add_argument(
+        "--workers",
+        help="Number of processes used to validate image headers (default: 1)",
+        type=int,
+        default=1
+    )
+    p.add_argument(
+        "--quarantine_dir",
+        help="Move images that fail validation to this directory (default: None)",
+        default=None
+    )
 
     p = add_command(
         "create_from_images_raw_with_labels",
@@ -962,7 +2213,7 @@ def execute_cmdline(argv):
         "create_from_images_raw datasets/mydataset myimagedir",
     )
     p.add_argument("tfrecord_dir", help="New dataset directory to be created")
-    p.add_argument("image_dir", help="Directory containing the images")
+    p.add_argument("image_dir", help="Directory or .tar/.zip archive containing the images")
     p.add_argument(
         "--resize",
         help="resize to given power of 2 sized square images (default: None)",
@@ -979,7 +2230,100 @@ def execute_cmdline(argv):
         type=int,
         default=7
     )
+    p.add_argument(
+        "--shard_mb",
+        help="Split the dataset into tfrecords shards of about this size, 0 = single file (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--resume",
+        help="Continue an interrupted run from its last completed shard; implies --shard_mb=256 if unset (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--validate",
+        help="Check the header of every image and skip mismatching ones before adding (default: 1)",
+        type=int,
+        default=1
+    )
+    p.add_argument(
+        "--workers",
+        help="Number of processes used to validate image headers (default: 1)",
+        type=int,
+        default=1
+    )
+    p.add_argument(
+        "--quarantine_dir",
+        help="Move images that fail validation to this directory (default: None)",
+        default=None
+    )
     
+    p = add_command(
+        "append",
+        "Append images to a dataset created with create_from_images_raw, skipping duplicates.",
+        "append datasets/mydataset mynewimagedir",
+    )
+    p.add_argument("tfrecord_dir", help="Existing dataset directory")
+    p.add_argument("image_dir", help="Directory or .tar/.zip archive containing the new images")
+    p.add_argument(
+        "--shuffle", help="Randomize image order (default: 1)", type=int, default=1
+    )
+    p.add_argument(
+        "--shard_mb",
+        help="Split the new images into tfrecords shards of about this size, 0 = one new shard (default: 0)",
+        type=int,
+        default=0
+    )
+    p.add_argument(
+        "--phash",
+        help="Also skip images with the same perceptual hash (default: 0)",
+        type=int,
+        default=0
+    )
+
+    p = add_command(
+        "create_mmap",
+        "Create a memory-mapped uint8 array dataset for training.dataset.MmapDataset.",
+        "create_mmap datasets/mydataset-mmap myimagedir --resize=6",
+    )
+    p.add_argument("dataset_dir", help="New dataset directory to be created")
+    p.add_argument("image_dir", help="Directory or .tar/.zip archive containing the images")
+    p.add_argument(
+        "--shuffle", help="Randomize image order (default: 1)", type=int, default=1
+    )
+    p.add_argument(
+        "--res_log2",
+        help="image width and height should be multiple of 2**res_log2 (default: 7)",
+        type=int,
+        default=7
+    )
+    p.add_argument(
+        "--resize",
+        help="resize to given power of 2 sized square images (default: None)",
+        type=int,
+        default=None
+    )
+    p.add_argument(
+        "--min_h",
+        help="Center-crop and resize to a height of min_h * 2**res_log2 (default: None)",
+        type=int,
+        default=None
+    )
+    p.add_argument(
+        "--min_w",
+        help="Center-crop and resize to a width of min_w * 2**res_log2 (default: None)",
+        type=int,
+        default=None
+    )
+    p.add_argument(
+        "--workers",
+        help="Number of processes used to decode and resize the images (default: 1)",
+        type=int,
+        default=1
+    )
+
     p = add_command(
         "create_from_hdf5",
         "Create dataset from legacy HDF5 archive.",
@@ -17,6 +17,10 @@ from training import misc
 
 #----------------------------------------------------------------------------
 
+INCEPTION_URL = 'http://d36zk2xti64re0.cloudfront.net/stylegan1/networks/metrics/inception_v3_features.pkl'
+
+#----------------------------------------------------------------------------
+
 class FID(metric_base.MetricBase):
     def __init__(self, num_images, minibatch_per_gpu, **kwargs):
         super().__init__(**kwargs)
@@ -25,7 +29,7 @@ class FID(metric_base.MetricBase):
 
     def _evaluate(self, Gs, Gs_kwargs, num_gpus):
         minibatch_size = num_gpus * self.minibatch_per_gpu
-        inception = misc.load_pkl('http://d36zk2xti64re0.cloudfront.net/stylegan1/networks/metrics/inception_v3_features.pkl')
+        inception = misc.load_pkl(INCEPTION_URL)
         activations = np.empty([self.num_images, inception.output_shape[1]], dtype=np.float32)
 
         # Calculate statistics for reals.
@@ -34,14 +38,17 @@ class FID(metric_base.MetricBase):
         if os.path.isfile(cache_file):
             mu_real, sigma_real = misc.load_pkl(cache_file)
         else:
-            for idx, images in enumerate(self._iterate_reals(minibatch_size=minibatch_size)):
-                begin = idx * minibatch_size
-                end = min(begin + minibatch_size, self.num_images)
-                activations[begin:end] = inception.run(images[:end-begin], num_gpus=num_gpus, assume_frozen=True)
-                if end == self.num_images:
-                    break
-            mu_real = np.mean(activations, axis=0)
-            sigma_real = np.cov(activations, rowvar=False)
+            real_activations = self._get_reals_features(self.num_images, INCEPTION_URL)
+            if real_activations is None:
+                for idx, images in enumerate(self._iterate_reals(minibatch_size=minibatch_size)):
+                    begin = idx * minibatch_size
+                    end = min(begin + minibatch_size, self.num_images)
+                    activations[begin:end] = inception.run(images[:end-begin], num_gpus=num_gpus, assume_frozen=True)
+                    if end == self.num_images:
+                        break
+                real_activations = activations
+            mu_real = np.mean(real_activations, axis=0)
+            sigma_real = np.cov(real_activations, rowvar=False)
             misc.save_pkl((mu_real, sigma_real), cache_file)
 
         # Construct TensorFlow graph.
@@ -16,6 +16,7 @@ import dnnlib.tflib as tflib
 
 from training import misc
 from training import dataset
+from training import records
 
 #----------------------------------------------------------------------------
 # Base class for metrics.
@@ -122,13 +123,51 @@ class MetricBase:
         return self._dataset_obj
 
     def _iterate_reals(self, minibatch_size):
-        dataset_obj = self._get_dataset_obj()
-        while True:
-            images, _labels = dataset_obj.get_minibatch_np(minibatch_size)
+        for images in self._iterate_real_minibatches(minibatch_size):
             if self._mirror_augment:
                 images = misc.apply_mirror_augment(images)
             yield images
 
+    def _iterate_real_minibatches(self, minibatch_size):
+        if self._dataset_args.get('class_name', 'training.dataset.TFRecordDataset') == 'training.dataset.TFRecordDataset':
+            # Decode tfrecords in worker processes, without going through a TF session.
+            tfrecord_dir = self._dataset_args['tfrecord_dir']
+            if self._data_dir is not None:
+                tfrecord_dir = os.path.join(self._data_dir, tfrecord_dir)
+            reader = records.NumpyReader(tfrecord_dir, decode_scale=self._dataset_args.get('decode_scale', 1))
+            for images, _labels in reader.iterate_minibatches(minibatch_size, repeat=True):
+                yield images
+        else:
+            dataset_obj = self._get_dataset_obj()
+            while True:
+                images, _labels = dataset_obj.get_minibatch_np(minibatch_size)
+                yield images
+
+    def _get_reals_features(self, num_images, network):
+        # Features of the first num_images reals from the bank written by "dataset_tool.py create_stats", or None.
+        if self._dataset_args.get('class_name', 'training.dataset.TFRecordDataset') != 'training.dataset.TFRecordDataset':
+            return None
+        if self._dataset_args.get('decode_scale', 1) != 1:
+            return None
+        tfrecord_dir = self._dataset_args['tfrecord_dir']
+        if self._data_dir is not None:
+            tfrecord_dir = os.path.join(self._data_dir, tfrecord_dir)
+        bank = records.load_feature_bank(tfrecord_dir, network)
+        if bank is None:
+            return None
+        num_reals = len(records.open_record_reader(tfrecord_dir)[0])
+        if len(bank) < min(num_images, num_reals):
+            return None # bank covers too few reals
+        order = np.arange(num_images) % num_reals # _iterate_reals wraps around the dataset
+        features = bank[order]
+        if self._mirror_augment:
+            mirror_bank = records.load_feature_bank(tfrecord_dir, network, mirror=True)
+            if mirror_bank is None:
+                return None
+            mask = np.random.rand(num_images) < 0.5 # same as misc.apply_mirror_augment
+            features[mask] = mirror_bank[order[mask]]
+        return features
+
     def _iterate_fakes(self, Gs, minibatch_size, num_gpus):
         while True:
             latents = np.random.randn(minibatch_size, *Gs.input_shape[1:])
@@ -156,6 +156,7 @@ class Projector:
         if sh[2] > self._target_images_var.shape[2]:
             factor = sh[2] // self._target_images_var.shape[2]
             target_images = np.reshape(target_images, [-1, sh[1], sh[2] // factor, factor, sh[3] // factor, factor]).mean((3, 5))
+        assert list(target_images.shape) == self._target_images_var.shape.as_list()  # targets may also arrive pre-scaled
 
         # Initialize optimization state.
         self._info('Initializing optimization state...')
@@ -6,6 +6,7 @@
 
 import argparse
 import numpy as np
+import os
 import dnnlib
 import dnnlib.tflib as tflib
 import re
@@ -13,8 +14,8 @@ import sys
 
 import projector
 import pretrained_networks
-from training import dataset
 from training import misc
+from training import records
 
 #----------------------------------------------------------------------------
 
@@ -59,14 +60,20 @@ def project_real_images(network_pkl, dataset_name, data_dir, num_images, num_sna
     proj.set_network(Gs)
 
     print('Loading images from "%s"...' % dataset_name)
-    dataset_obj = dataset.load_dataset(data_dir=data_dir, tfrecord_dir=dataset_name, max_label_size=0, repeat=False, shuffle_mb=0)
-    assert dataset_obj.shape == Gs.output_shape[1:]
-
+    # The projector compares images at 256px at most; decode the targets at that size directly.
+    decode_scale = Gs.output_shape[2] // 256 if Gs.output_shape[2] > 256 else 1
+    if decode_scale not in [1, 2, 4, 8]:
+        decode_scale = 1  # let the projector box-filter the full-size targets
+    reader = records.NumpyReader(os.path.join(data_dir, dataset_name), decode_scale=decode_scale, num_workers=0)
+    assert reader.shape == [Gs.output_shape[1], Gs.output_shape[2] // decode_scale, Gs.output_shape[3] // decode_scale]
+
+    minibatches = reader.iterate_minibatches(1)
     for image_idx in range(num_images):
         print('Projecting image %d/%d ...' % (image_idx, num_images))
-        images, _labels = dataset_obj.get_minibatch_np(1)
+        images, _labels = next(minibatches)
         images = misc.adjust_dynamic_range(images, [0, 255], [-1, 1])
         project_image(proj, targets=images, png_prefix=dnnlib.make_run_dir_path('image%04d-' % image_idx), num_snapshots=num_snapshots)
+    minibatches.close()
 
 #----------------------------------------------------------------------------
 
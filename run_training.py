@@ -33,7 +33,7 @@ _valid_configs = [
 
 #----------------------------------------------------------------------------
 
-def run(dataset, data_dir, result_dir, config_id, num_gpus, total_kimg, gamma, mirror_augment, mirror_augment_v, metrics, min_h, min_w, res_log2, lr):
+def run(dataset, data_dir, result_dir, config_id, num_gpus, total_kimg, gamma, mirror_augment, mirror_augment_v, metrics, min_h, min_w, res_log2, lr, random_access, mmap, cache_dir, memory_cache_mb):
     train     = EasyDict(run_func_name='training.training_loop.training_loop') # Options for training loop.
     G         = EasyDict(func_name='training.networks_stylegan2.G_main')       # Options for generator network.
     D         = EasyDict(func_name='training.networks_stylegan2.D_stylegan2')  # Options for discriminator network.
@@ -64,6 +64,13 @@ def run(dataset, data_dir, result_dir, config_id, num_gpus, total_kimg, gamma, m
     G.min_h = D.min_h = dataset_args.min_h = min_h
     G.min_w = D.min_w = dataset_args.min_w = min_w
     G.res_log2 = D.res_log2 = dataset_args.res_log2 = res_log2
+    dataset_args.random_access = random_access
+    if mmap:
+        dataset_args.class_name = 'training.dataset.MmapDataset'
+    if cache_dir is not None:
+        dataset_args.cache_dir = cache_dir
+    if memory_cache_mb > 0:
+        dataset_args.memory_cache_mb = memory_cache_mb
     assert num_gpus in [1, 2, 4, 8]
     sc.num_gpus = num_gpus
     desc += '-%dgpu' % num_gpus
@@ -177,6 +184,10 @@ def main():
     parser.add_argument('--min-w', help='lowest dim of width', default=4, type=int)
     parser.add_argument('--res-log2', help='multiplier for image size, the training image size (height, width) should be (min_h * 2**res_log2, min_w * 2**res_log2)', default=7, type=int)
     parser.add_argument('--lr', help='base learning rate', default=0.003, type=float)
+    parser.add_argument('--random-access', help='Read the dataset in a true random order every epoch (default: %(default)s)', default=False, metavar='BOOL', type=_str_to_bool)
+    parser.add_argument('--mmap', help='Train from an array created with dataset_tool.py create_mmap (default: %(default)s)', default=False, metavar='BOOL', type=_str_to_bool)
+    parser.add_argument('--cache-dir', help='Local directory to cache the dataset shards in, useful when --data-dir is a slow mount (default: none)', default=None, metavar='DIR')
+    parser.add_argument('--memory-cache-mb', help='Keep the decoded dataset in memory if it fits in this many MB, 0 = disable (default: %(default)s)', default=0, type=int)
     
     args = parser.parse_args()
 
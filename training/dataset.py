@@ -2,17 +2,22 @@
 
 import glob
 import os
+import threading
+import time
 
 import dnnlib
 import dnnlib.tflib as tflib
 import numpy as np
 import tensorflow as tf
 
+from training import records
+from training.records import expand_labels_np, find_label_file, load_labels
+
 # ----------------------------------------------------------------------------
 # Parse individual image from a tfrecords file.
 
 
-def parse_tfrecord_tf(record):
+def parse_tfrecord_tf(record, decode_scale=1, codec="none"):
     features = tf.parse_single_example(
         record,
         features={
@@ -20,10 +25,22 @@ def parse_tfrecord_tf(record):
             "data": tf.FixedLenFeature([], tf.string),
         },
     )
-    data = tf.decode_raw(features["data"], tf.uint8)
-    return tf.reshape(data, features["shape"])
+    if codec == "png":
+        data = tf.transpose(tf.image.decode_png(features["data"]), [2, 0, 1])
+    elif codec in ["webp", "lz4"]:  # no TF op, decoded by the same code as records.NumpyReader
+        decode_func = lambda data, shape: records.decode_pixels(data, shape, codec)
+        data = tf.py_func(decode_func, [features["data"], features["shape"]], tf.uint8, stateful=False)
+    elif codec == "zlib":
+        data = tf.decode_raw(tf.io.decode_compressed(features["data"], compression_type="ZLIB"), tf.uint8)
+    else:
+        assert codec == "none"
+        data = tf.decode_raw(features["data"], tf.uint8)
+    data = tf.reshape(data, features["shape"])
+    if decode_scale > 1:
+        data = tf.transpose(downscale_hwc_tf(tf.transpose(data, [1, 2, 0]), decode_scale), [2, 0, 1])
+    return data
 
-def parse_tfrecord_tf_raw(record):
+def parse_tfrecord_tf_raw(record, decode_scale=1):
     features = tf.parse_single_example(
         record,
         features={
@@ -31,10 +48,23 @@ def parse_tfrecord_tf_raw(record):
             "img": tf.FixedLenFeature([], tf.string),
         },
     )
-    image = tf.image.decode_image(features['img']) 
+    if decode_scale > 1:
+        # JPEGs are downscaled during decoding, in the DCT domain; others are decoded and box-filtered.
+        image = tf.cond(
+            tf.image.is_jpeg(features["img"]),
+            lambda: tf.image.decode_jpeg(features["img"], ratio=decode_scale),
+            lambda: downscale_hwc_tf(tf.image.decode_image(features["img"], expand_animations=False), decode_scale),
+        )
+    else:
+        image = tf.image.decode_image(features['img']) 
     return tf.transpose(image, [2,0,1]) 
     #return tf.reshape(data, features["shape"])
 
+def downscale_hwc_tf(image, factor):  # box filter, height and width must be multiples of factor
+    sh = tf.shape(image)
+    image = tf.reshape(tf.cast(image, tf.float32), [sh[0] // factor, factor, sh[1] // factor, factor, sh[2]])
+    return tf.cast(tf.round(tf.reduce_mean(image, axis=[1, 3])), tf.uint8)
+
 def parse_tfrecord_np(record):
     ex = tf.train.Example()
     ex.ParseFromString(record)
@@ -57,6 +87,47 @@ def parse_tfrecord_np_raw(record):
     ]  # temporary pylint workaround # pylint: disable=no-member
     return shape
 
+def get_tfrecord_feature_np(record):  # => "img" or "data"
+    ex = tf.train.Example()
+    ex.ParseFromString(record)
+    return "img" if "img" in ex.features.feature else "data"
+
+# ----------------------------------------------------------------------------
+# Labels stored next to the images, see records.load_labels().
+
+
+def expand_labels_tf(labels, label_size, multi_hot=False):  # => [..., label_size] float32
+    # Takes rows gathered from the stored labels; -1 padding and indices >= label_size give zeros.
+    if labels.dtype != tf.int32:
+        return tf.cast(labels, tf.float32)
+    dense = tf.one_hot(labels, label_size, dtype=tf.float32)
+    return tf.reduce_max(dense, axis=-2) if multi_hot else dense
+
+# ----------------------------------------------------------------------------
+# Counts the images produced by an input pipeline. The prefetch buffers keep
+# this rate in step with training while the pipeline keeps up; when the
+# training rate drops to it and stays there, the pipeline is the bottleneck.
+
+
+class ThroughputMeter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._start = time.time()
+
+    def add(self, num_images):
+        with self._lock:
+            self._count += int(num_images)
+        return np.int32(num_images)
+
+    def get_rate(self):  # => images per second since the previous call
+        with self._lock:
+            now = time.time()
+            rate = self._count / max(now - self._start, 1e-6)
+            self._count = 0
+            self._start = now
+        return rate
+
 # ----------------------------------------------------------------------------
 # Dataset class that loads data from tfrecords files.
 
@@ -75,8 +146,16 @@ class TFRecordDataset:
         shuffle_mb=4096,  # Shuffle data within specified window (megabytes), 0 = disable shuffling.
         prefetch_mb=2048,  # Amount of data to prefetch (megabytes), 0 = disable prefetching.
         buffer_mb=256,  # Read buffer size (megabytes).
-        num_threads=2,
-    ):  # Number of concurrent threads.
+        num_threads=0,  # Number of concurrent decode threads, 0 = autotune.
+        num_readers=4,  # Number of shards read in parallel, 0 = autotune.
+        random_access=False,  # Read records through a memory map in a true random permutation per epoch.
+        decode_scale=1,  # Return images downscaled by 1, 2, 4 or 8; JPEGs are decoded at the reduced size.
+        cache_dir=None,  # Local directory to cache the shards in while reading them, None = disable.
+        cache_mb=16384,  # Disk budget of the shard cache (megabytes).
+        memory_cache_mb=0,  # Keep the decoded images in memory if they fit in this budget (megabytes), 0 = disable.
+        worker_index=0,  # Index of this training process among num_workers.
+        num_workers=1,  # Number of training processes sharing the dataset; each reads a disjoint part per epoch.
+    ):
 
         self.tfrecord_dir = tfrecord_dir
         #self.res_log2 = res_log2
@@ -91,95 +170,252 @@ class TFRecordDataset:
         self._np_labels = None
         self._tf_minibatch_in = None
         self._tf_labels_var = None
-        self._tf_labels_dataset = None
         self._tf_datasets = dict()
         self._tf_iterator = None
         self._tf_init_ops = dict()
         self._tf_minibatch_np = None
+        self._record_reader = None
+        self._cache = None
+        self._shard_info = dict()  # tfr_file => (num_bytes, sha1)
+        assert 0 <= worker_index < num_workers
+        self.worker_index = worker_index
+        self.num_workers = num_workers
+        self._meter = ThroughputMeter()
         self._cur_minibatch = -1
         self.min_h = min_h
         self.min_w = min_w
-        # List tfrecords files and inspect their shapes.
+        # List tfrecords shards from the manifest, or fall back to the highest
+        # resolution tfrecords file of a dataset created without one.
         assert os.path.isdir(self.tfrecord_dir)
-        tfr_files = sorted(glob.glob(os.path.join(self.tfrecord_dir, "*.tfrecords")))
-        assert len(tfr_files) >= 1
-        tfr_shapes = []
-        for tfr_file in tfr_files:
+        self.manifest = records.load_manifest(self.tfrecord_dir)
+        if self.manifest is not None:
+            tfr_files = records.get_shard_paths(self.tfrecord_dir, self.manifest)
+            tfr_offsets = [shard["first_record"] for shard in self.manifest["shards"]]
+            tfr_counts = [shard["num_records"] for shard in self.manifest["shards"]]
+            tfr_shape = self.manifest["shape"]
+            tfr_feature = self.manifest["feature"]
+            tfr_codec = self.manifest.get("codec", "none")
+            for tfr_file, shard in zip(tfr_files, self.manifest["shards"]):
+                self._shard_info[tfr_file] = (shard["num_bytes"], shard.get("sha1"))
+            num_bytes = sum(shard["num_bytes"] for shard in self.manifest["shards"])
+            bytes_per_record = num_bytes // max(self.manifest["num_records"], 1)
+            if self.label_file is None and self.manifest["label_file"] is not None:
+                self.label_file = os.path.join(self.tfrecord_dir, self.manifest["label_file"])
+        else:
+            tfr_files = sorted(glob.glob(os.path.join(self.tfrecord_dir, "*.tfrecords")))
+            assert len(tfr_files) >= 1
+            tfr_files = tfr_files[-1:]  # should be the highest resolution tf_record file
+            tfr_offsets = [0]
+            tfr_counts = [1 << 62]  # record count unknown, read until the end of the file
             tfr_opt = tf.python_io.TFRecordOptions(
                 tf.python_io.TFRecordCompressionType.NONE
             )
-            for record in tf.python_io.tf_record_iterator(tfr_file, tfr_opt):
-                #tfr_shapes.append(parse_tfrecord_np(record).shape)
-                tfr_shapes.append(parse_tfrecord_np_raw(record))
+            for record in tf.python_io.tf_record_iterator(tfr_files[0], tfr_opt):
+                tfr_shape = parse_tfrecord_np_raw(record)
+                tfr_feature = get_tfrecord_feature_np(record)
+                tfr_codec = "none"
+                bytes_per_record = len(record)  # assume the first record is typical
                 break
+        assert len(tfr_files) >= 1
+        if cache_dir is not None:
+            self._cache = records.ShardCache(cache_dir, cache_mb)
 
         # Autodetect label filename.
-        if self.label_file is None:
-            guess = sorted(glob.glob(os.path.join(self.tfrecord_dir, "*.labels")))
-            if len(guess):
-                self.label_file = guess[0]
-        elif not os.path.isfile(self.label_file):
-            guess = os.path.join(self.tfrecord_dir, self.label_file)
-            if os.path.isfile(guess):
-                self.label_file = guess
+        self.label_file = find_label_file(self.tfrecord_dir, self.label_file)
 
         # Determine shape and resolution.
-        max_shape = max(tfr_shapes, key=np.prod)
         #self.resolution = resolution if resolution is not None else max_shape[1]
         #self.resolution_log2 = int(np.log2(self.resolution))
         #self.shape = [max_shape[0], self.resolution, self.resolution]
-        self.shape = [max_shape[0], max_shape[1], max_shape[2]] 
-        assert all(shape[0] == max_shape[0] for shape in tfr_shapes)
-        #assert all(shape[1] == shape[2] for shape in tfr_shapes)
+        assert decode_scale in [1, 2, 4, 8]
+        assert tfr_shape[1] % decode_scale == 0 and tfr_shape[2] % decode_scale == 0
+        self.decode_scale = decode_scale
+        self.shape = [int(tfr_shape[0]), int(tfr_shape[1]) // decode_scale, int(tfr_shape[2]) // decode_scale]
 
         # Load labels.
-        assert max_label_size == "full" or max_label_size >= 0
-        self._np_labels = np.zeros([1 << 20, 0], dtype=np.float32)
-        if self.label_file is not None and max_label_size != 0:
-            self._np_labels = np.load(self.label_file)
-            assert self._np_labels.ndim == 2
-        if max_label_size != "full" and self._np_labels.shape[1] > max_label_size:
-            self._np_labels = self._np_labels[:, :max_label_size]
-        self.label_size = self._np_labels.shape[1]
-        self.label_dtype = self._np_labels.dtype.name
+        num_classes = None
+        if self.manifest is not None and self.label_file is not None:
+            if os.path.basename(self.label_file) == self.manifest["label_file"]:
+                num_classes = self.manifest["label_size"]
+        self._np_labels, self.label_size = load_labels(self.label_file, max_label_size, num_classes)
+        self.label_dtype = "float32"
 
         # Build TF expressions.
+        num_threads = num_threads if num_threads > 0 else tf.data.experimental.AUTOTUNE
         with tf.name_scope("Dataset"), tf.device("/cpu:0"):
             self._tf_minibatch_in = tf.placeholder(
                 tf.int64, name="minibatch_in", shape=[]
             )
-            self._tf_labels_var = tflib.create_var_with_large_initial_value(
-                self._np_labels, name="labels_var"
-            )
-            self._tf_labels_dataset = tf.data.Dataset.from_tensor_slices(
-                self._tf_labels_var
-            )
+            if self._np_labels is not None:
+                self._tf_labels_var = tflib.create_var_with_large_initial_value(
+                    self._np_labels, name="labels_var"
+                )
 
-            # only use the full resolution version file tfr_file
-            # This portion of the code has been edited to make sure that the Dataset
-            # only returns the highest resolution files
-            tfr_file = tfr_files[-1]  # should be the highest resolution tf_record file
-            tfr_shape = tfr_shapes[-1]  # again the highest resolution shape
-            dset = tf.data.TFRecordDataset(
-                tfr_file, compression_type="", buffer_size=buffer_mb << 20
-            )
-            #dset = dset.map(parse_tfrecord_tf, num_parallel_calls=num_threads)
-            dset = dset.map(parse_tfrecord_tf_raw, num_parallel_calls=num_threads)
-            dset = tf.data.Dataset.zip((dset, self._tf_labels_dataset))
-            bytes_per_item = np.prod(tfr_shape) * np.dtype(self.dtype).itemsize
-            if shuffle_mb > 0:
-                dset = dset.shuffle(((shuffle_mb << 20) - 1) // bytes_per_item + 1)
-            if repeat:
-                dset = dset.repeat()
-            if prefetch_mb > 0:
+            # Each record is paired with its global index so that labels stay
+            # aligned no matter in which order the shards are read.
+            if tfr_feature == "img":
+                parse_func = parse_tfrecord_tf_raw
+            else:
+                parse_func = lambda record, decode_scale: parse_tfrecord_tf(record, decode_scale, tfr_codec)
+            parse_record = lambda record, index: (parse_func(record, decode_scale), self._get_labels_for_index_tf(index))
+            # Shuffling and prefetching operate on the serialized records, which
+            # for encoded images are several times smaller than the decoded
+            # pixels; images are only decoded right before batching.
+            bytes_per_item = max(int(bytes_per_record), 1)
+
+            # Small datasets are decoded once and kept in memory; shuffling and
+            # repeating then happen on the cached images instead of the records.
+            decoded_bytes = int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+            if self.manifest is not None:
+                num_images = self.manifest["num_records"]
+            else:
+                num_images = os.path.getsize(tfr_files[0]) // bytes_per_item  # estimate
+            use_memory_cache = False
+            if memory_cache_mb > 0:
+                use_memory_cache = num_images * decoded_bytes <= memory_cache_mb << 20
+                if not use_memory_cache:
+                    print("Decoded dataset needs about %d MB, more than memory_cache_mb; streaming it instead."
+                          % ((num_images * decoded_bytes) >> 20))
+            shuffle_records = shuffle_mb > 0 and not use_memory_cache
+            repeat_records = repeat and not use_memory_cache
+
+            # With several training processes, all of them permute the shards
+            # (or, for random access, the records) of every epoch with the same
+            # seed and each reads an equal, disjoint share of the records, so
+            # aggregate I/O stays constant and the workers' epochs stay in step.
+            # With a memory cache each worker keeps its first share.
+            self._random_access = random_access
+            self._shuffle_epochs = shuffle_records
+            split_records = num_workers > 1
+            epochs = tf.data.Dataset.range((1 << 62) if repeat_records else 1)
+
+            if random_access or split_records:
+                # Read records through a memory map of the shards. For random
+                # access, visit every record once per epoch in a fresh random
+                # permutation; only the record indices are shuffled, so no large
+                # shuffle buffer is needed. Otherwise read contiguous runs of
+                # records, see _select_records_np().
+                self._record_reader = records.RecordReader(
+                    tfr_files, self._resolve_shard if self._cache is not None else None
+                )
+                num_records = len(self._record_reader)
+                if split_records:
+                    dset = epochs.flat_map(lambda epoch: self._worker_epoch_tf(self._select_records_np, epoch, [tf.int64]))
+                else:
+                    dset = tf.data.Dataset.range(num_records)
+                    if shuffle_records:
+                        dset = dset.shuffle(num_records, reshuffle_each_iteration=True)
+                    if repeat_records:
+                        dset = dset.repeat()
+                dset = dset.map(
+                    lambda index: (tf.py_func(self._record_reader.read, [index], tf.string, stateful=False), index),
+                    num_parallel_calls=num_threads,
+                )
+                if shuffle_records and not random_access:
+                    dset = dset.shuffle(((shuffle_mb << 20) - 1) // bytes_per_item + 1)
+            else:
+                cycle_length = min(num_readers, len(tfr_files)) if num_readers > 0 else tf.data.experimental.AUTOTUNE
+                num_readers = max(min(num_readers, len(tfr_files)), 1)
+                def read_shard(tfr_file, first_record, num_records):
+                    records_dset = tf.data.TFRecordDataset(
+                        tfr_file, compression_type="", buffer_size=(buffer_mb << 20) // num_readers
+                    )
+                    index_dset = tf.data.Dataset.range(first_record, first_record + num_records)
+                    return tf.data.Dataset.zip((records_dset, index_dset))
+
+                dset = tf.data.Dataset.from_tensor_slices(
+                    (tfr_files, np.int64(tfr_offsets), np.int64(tfr_counts))
+                )
+                if shuffle_records:
+                    dset = dset.shuffle(len(tfr_files))
+                if self._cache is not None:  # pick the local copy, if any, each time a shard is opened
+                    resolve_func = lambda tfr_file: self._resolve_shard(tfr_file.decode("utf-8")).encode("utf-8")
+                    dset = dset.map(lambda tfr_file, first_record, num_records: (
+                        tf.py_func(resolve_func, [tfr_file], tf.string, stateful=True), first_record, num_records))
+                dset = dset.interleave(
+                    read_shard, cycle_length=cycle_length, num_parallel_calls=tf.data.experimental.AUTOTUNE
+                )
+                if shuffle_records:
+                    dset = dset.shuffle(((shuffle_mb << 20) - 1) // bytes_per_item + 1)
+                if repeat_records:
+                    dset = dset.repeat()
+            if prefetch_mb > 0 and not use_memory_cache:
                 dset = dset.prefetch(((prefetch_mb << 20) - 1) // bytes_per_item + 1)
+            dset = dset.map(parse_record, num_parallel_calls=num_threads)
+            if use_memory_cache:
+                dset = dset.cache()
+                if shuffle_mb > 0:
+                    dset = dset.shuffle(min(num_images, ((shuffle_mb << 20) - 1) // decoded_bytes + 1), reshuffle_each_iteration=True)
+                if repeat:
+                    dset = dset.repeat()
             dset = dset.batch(self._tf_minibatch_in)
+            dset = dset.map(self._count_minibatch_tf)
+            dset = dset.prefetch(tf.data.experimental.AUTOTUNE)  # decode ahead while the current minibatch is in use
             self._tf_dataset = dset
             self._tf_iterator = tf.data.Iterator.from_structure(
                 self._tf_dataset.output_types, self._tf_dataset.output_shapes
             )
             self._tf_init_op = self._tf_iterator.make_initializer(self._tf_dataset)
 
+    # Items read by this worker in the given epoch, as a dataset.
+    def _worker_epoch_tf(self, select_func, epoch, dtypes):
+        items = tf.py_func(select_func, [epoch], dtypes, stateful=False)
+        for item in items:
+            item.set_shape([None])
+        return tf.data.Dataset.from_tensor_slices(tuple(items) if len(items) > 1 else items[0])
+
+    # Record indices read by this worker in the given epoch. Without random
+    # access, the shards are taken in a shuffled order and their records cut
+    # into equal contiguous runs, so reads stay sequential and every worker
+    # gets the same number of records whatever the shard sizes.
+    def _select_records_np(self, epoch):
+        rng = np.random.RandomState(epoch % (1 << 32))
+        if self._random_access:
+            order = np.arange(len(self._record_reader), dtype=np.int64)
+            if self._shuffle_epochs:
+                rng.shuffle(order)
+            return order[self.worker_index :: self.num_workers]
+        shard_sizes = self._record_reader.shard_sizes()
+        shard_firsts = np.cumsum(shard_sizes) - shard_sizes
+        shard_order = np.arange(len(shard_sizes))
+        if self._shuffle_epochs:
+            rng.shuffle(shard_order)
+        order = np.concatenate([np.arange(shard_firsts[i], shard_firsts[i] + shard_sizes[i]) for i in shard_order])
+        begin = len(order) * self.worker_index // self.num_workers
+        end = len(order) * (self.worker_index + 1) // self.num_workers
+        return order[begin:end].astype(np.int64)
+
+    # Look up the label of the record with the given global index.
+    def _get_labels_for_index_tf(self, index):
+        if self.label_size > 0:
+            return self._expand_labels_tf(tf.gather(self._tf_labels_var, index))
+        return tf.zeros([0], self.label_dtype)
+
+    # Expand gathered rows of the stored labels to dense vectors.
+    def _expand_labels_tf(self, labels):
+        multi_hot = self._np_labels.dtype == np.int32 and self._np_labels.ndim == 2
+        return expand_labels_tf(labels, self.label_size, multi_hot)
+
+    # Let every minibatch leaving the pipeline tick the throughput meter.
+    def _count_minibatch_tf(self, images, labels):
+        count = tf.py_func(self._meter.add, [tf.shape(images)[0]], tf.int32, stateful=True)
+        with tf.control_dependencies([count]):
+            return tf.identity(images), labels
+
+    # Images per second produced by the input pipeline since the previous call.
+    def get_images_per_sec(self):
+        return self._meter.get_rate()
+
+    # Path to read the given shard from: its local copy once the cache has one.
+    def _resolve_shard(self, tfr_file):
+        num_bytes, sha1 = self._shard_info.get(tfr_file, (None, None))
+        return self._cache.resolve(tfr_file, num_bytes, sha1)
+
+    # Stop copying shards to the local cache.
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
+
     # Use the given minibatch size and level-of-detail for the data returned by get_minibatch_tf().
     def configure(self, minibatch_size, lod_in=0):
         #lod is ignored for this hack
@@ -203,22 +439,125 @@ class TFRecordDataset:
     def get_random_labels_tf(self, minibatch_size):  # => labels
         if self.label_size > 0:
             with tf.device("/cpu:0"):
-                return tf.gather(
+                return self._expand_labels_tf(tf.gather(
                     self._tf_labels_var,
                     tf.random_uniform(
                         [minibatch_size], 0, self._np_labels.shape[0], dtype=tf.int32
                     ),
-                )
+                ))
         return tf.zeros([minibatch_size, 0], self.label_dtype)
 
     # Get random labels as NumPy array.
     def get_random_labels_np(self, minibatch_size):  # => labels
         if self.label_size > 0:
-            return self._np_labels[
+            return expand_labels_np(self._np_labels[
                 np.random.randint(self._np_labels.shape[0], size=[minibatch_size])
-            ]
+            ], self.label_size)
         return np.zeros([minibatch_size, 0], self.label_dtype)
 
+# ----------------------------------------------------------------------------
+# Dataset class that gathers minibatches from one memory-mapped [N, C, H, W]
+# uint8 array, as written by "dataset_tool.py create_mmap". Images are never
+# decoded or parsed; each minibatch is a single fancy-indexing copy out of the
+# page cache. Suited for small resolutions where the whole array fits on a
+# local disk.
+
+
+class MmapDataset(TFRecordDataset):  # shares the minibatch and label accessors
+    def __init__(  # pylint: disable=super-init-not-called
+        self,
+        tfrecord_dir,  # Directory containing the dataset.
+        res_log2=7,
+        min_h=4,
+        min_w=4,
+        resolution=None,  # Ignored, the shape is stored in the array.
+        label_file=None,  # Relative path of the labels file, None = autodetect.
+        max_label_size=0,  # 0 = no labels, 'full' = full labels, <int> = N first label components.
+        repeat=True,  # Repeat dataset indefinitely.
+        shuffle_mb=4096,  # 0 = disable shuffling, otherwise every epoch is a full random permutation.
+        prefetch_mb=2048,  # 0 = disable prefetching, otherwise minibatches are prefetched with an autotuned buffer.
+        num_threads=0,  # Number of concurrent threads, 0 = autotune.
+        random_access=True,  # Ignored, reads are always random access.
+        decode_scale=1,  # Return images box-filtered down by this factor.
+        cache_dir=None,  # Ignored, the array is read through the page cache.
+        cache_mb=16384,  # Ignored.
+        memory_cache_mb=0,  # Ignored, the array is read through the page cache.
+        worker_index=0,  # Ignored, every training process samples the whole array.
+        num_workers=1,  # Ignored.
+    ):
+
+        self.tfrecord_dir = tfrecord_dir
+        self.dtype = "uint8"
+        self.dynamic_range = [0, 255]
+        self._tf_minibatch_np = None
+        self._tf_labels_var = None
+        self._cache = None
+        self._meter = ThroughputMeter()
+        self._cur_minibatch = -1
+        self.min_h = min_h
+        self.min_w = min_w
+
+        # Map the image array and load labels.
+        assert os.path.isdir(self.tfrecord_dir)
+        guess = sorted(glob.glob(os.path.join(self.tfrecord_dir, "*-images.npy")))
+        assert len(guess) == 1
+        self._np_images = np.load(guess[0], mmap_mode="r")
+        assert self._np_images.ndim == 4 and self._np_images.dtype == np.uint8
+        c, h, w = self._np_images.shape[1:]
+        assert h % decode_scale == 0 and w % decode_scale == 0
+        self.decode_scale = decode_scale
+        self.shape = [c, h // decode_scale, w // decode_scale]
+        self.label_file = find_label_file(self.tfrecord_dir, label_file)
+        self._np_labels, self.label_size = load_labels(self.label_file, max_label_size)
+        self.label_dtype = "float32"
+        num_images = self._np_images.shape[0]
+        assert self.label_size == 0 or self._np_labels.shape[0] == num_images
+
+        # Build TF expressions.
+        num_threads = num_threads if num_threads > 0 else tf.data.experimental.AUTOTUNE
+        with tf.name_scope("Dataset"), tf.device("/cpu:0"):
+            self._tf_minibatch_in = tf.placeholder(
+                tf.int64, name="minibatch_in", shape=[]
+            )
+            if self._np_labels is not None:
+                self._tf_labels_var = tflib.create_var_with_large_initial_value(
+                    self._np_labels, name="labels_var"
+                )
+            dset = tf.data.Dataset.range(num_images)
+            if shuffle_mb > 0:
+                dset = dset.shuffle(num_images, reshuffle_each_iteration=True)
+            if repeat:
+                dset = dset.repeat()
+            dset = dset.batch(self._tf_minibatch_in)
+            dset = dset.map(self._gather_minibatch_tf, num_parallel_calls=num_threads)
+            dset = dset.map(self._count_minibatch_tf)
+            if prefetch_mb > 0:  # minibatch size is only known at run time, let tf.data size the buffer
+                dset = dset.prefetch(tf.data.experimental.AUTOTUNE)
+            self._tf_dataset = dset
+            self._tf_iterator = tf.data.Iterator.from_structure(
+                self._tf_dataset.output_types, self._tf_dataset.output_shapes
+            )
+            self._tf_init_op = self._tf_iterator.make_initializer(self._tf_dataset)
+
+    def _gather_minibatch_np(self, indices):
+        indices = np.sort(indices)  # read the memory map front to back
+        images = self._np_images[indices]
+        if self.decode_scale > 1:
+            s = self.decode_scale
+            images = images.reshape([-1, self.shape[0], self.shape[1], s, self.shape[2], s]).mean((3, 5))
+            images = np.rint(images).astype(np.uint8)
+        if self.label_size > 0:
+            return images, expand_labels_np(self._np_labels[indices], self.label_size)
+        return images, np.zeros([len(indices), 0], self.label_dtype)
+
+    def _gather_minibatch_tf(self, indices):
+        images, labels = tf.py_func(
+            self._gather_minibatch_np, [indices], [tf.uint8, tf.float32], stateful=False
+        )
+        images.set_shape([None] + self.shape)
+        labels.set_shape([None, self.label_size])
+        return images, labels
+
 # ----------------------------------------------------------------------------
 # Helper func for constructing a dataset object using the given options.
 
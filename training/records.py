@@ -0,0 +1,646 @@
+"""On-disk layout of TFRecord datasets (manifest, shard naming) and a NumPy reader, usable without TensorFlow."""
+
+import collections
+import glob
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# Dataset manifest.
+#
+# The manifest is a JSON file written next to the shards by TFRecordExporter:
+#
+#   version       Layout version, currently 1.
+#   res_log2      Image width and height are multiples of 2**res_log2.
+#   shape         [channel, height, width] of every image.
+#   feature       "img" = encoded image bytes, "data" = raw uint8 pixels.
+#   codec         How "data" records are compressed, one of CODECS; absent
+#                 in datasets written before codecs existed, i.e. "none".
+#   num_records   Total number of records in all shards.
+#   expected_images  Number of images the exporter was created for.
+#   complete      False while the dataset is still being written; the
+#                 shards listed so far are durable and can be resumed from.
+#   label_file    Basename of the labels file, or None.
+#   label_size    Number of label components, 0 = no labels.
+#   label_dtype   Element type of the labels, or None.
+#   hash_file     Basename of the content-hash index (see below).
+#   shards        List of dicts with "file", "first_record", "num_records",
+#                 "num_bytes", "sha1", "shape" and "index", in record order.
+
+MANIFEST_VERSION = 1
+
+
+def manifest_filename(tfr_prefix):
+    return tfr_prefix + "-manifest.json"
+
+
+def shard_filename(tfr_prefix, res_log2, shard_idx=None):
+    if shard_idx is None:  # single-file dataset
+        return tfr_prefix + "-r%02d.tfrecords" % res_log2
+    return tfr_prefix + "-r%02d-%05d.tfrecords" % (res_log2, shard_idx)
+
+
+def find_manifest(tfrecord_dir):
+    guess = sorted(glob.glob(os.path.join(tfrecord_dir, "*-manifest.json")))
+    return guess[0] if len(guess) else None
+
+
+def load_manifest(tfrecord_dir):  # => dict or None
+    manifest_file = find_manifest(tfrecord_dir)
+    if manifest_file is None:
+        return None
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    assert manifest["version"] <= MANIFEST_VERSION
+    return manifest
+
+
+def save_manifest(manifest_file, manifest):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, manifest_file)  # never leave a half-written manifest behind
+
+
+def get_shard_paths(tfrecord_dir, manifest):
+    return [os.path.join(tfrecord_dir, shard["file"]) for shard in manifest["shards"]]
+
+
+def index_filename(tfr_file):
+    return os.path.splitext(tfr_file)[0] + ".index"
+
+
+def file_sha1(filename, chunk_bytes=8 << 20):  # => hex digest
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# ----------------------------------------------------------------------------
+# Per-record offset index.
+#
+# An uncompressed tfrecords file is a sequence of
+#   uint64 length, uint32 masked crc32c(length), byte data[length], uint32 masked crc32c(data)
+# The index of a shard is an int64 array of shape [num_records, 2] holding the
+# byte offset and length of each record's data, stored with np.save.
+
+RECORD_HEADER_BYTES = 12
+RECORD_FOOTER_BYTES = 4
+
+
+def scan_record_index(tfr_file):  # => [num_records, 2] int64 array
+    # Walk the record headers only; used for shards written without an index.
+    index = []
+    with open(tfr_file, "rb") as f:
+        pos = 0
+        while True:
+            header = f.read(RECORD_HEADER_BYTES)
+            if len(header) < RECORD_HEADER_BYTES:
+                break
+            length = struct.unpack("<Q", header[:8])[0]
+            index.append((pos + RECORD_HEADER_BYTES, length))
+            pos += RECORD_HEADER_BYTES + length + RECORD_FOOTER_BYTES
+            f.seek(pos)
+    return np.array(index, dtype=np.int64).reshape(-1, 2)
+
+
+def load_record_index(tfr_file):  # => [num_records, 2] int64 array
+    index_file = index_filename(tfr_file)
+    if os.path.isfile(index_file):
+        return np.load(index_file)
+    return scan_record_index(tfr_file)
+
+
+class RecordReader:
+    """Random access to the records of a list of shards through memory maps.
+
+    resolve_func, if given, maps a shard path to the path to read it from,
+    e.g. ShardCache.resolve; shards are remapped once a local copy exists.
+    """
+
+    def __init__(self, tfr_files, resolve_func=None):
+        self.tfr_files = list(tfr_files)
+        self.resolve_func = resolve_func
+        self._maps = [None] * len(self.tfr_files)
+        self._map_files = [None] * len(self.tfr_files)
+        indices = [load_record_index(tfr_file) for tfr_file in self.tfr_files]
+        shard_ids = [np.full([len(index), 1], shard_idx, dtype=np.int64) for shard_idx, index in enumerate(indices)]
+        self._index = np.concatenate([np.concatenate([shard_ids[i], indices[i]], axis=1) for i in range(len(indices))])
+
+    def __len__(self):
+        return len(self._index)
+
+    def _get_map(self, shard_idx):
+        tfr_file = self.tfr_files[shard_idx]
+        if self.resolve_func is not None and self._map_files[shard_idx] in [None, tfr_file]:
+            tfr_file = self.resolve_func(tfr_file)
+        if self._maps[shard_idx] is None or self._map_files[shard_idx] != tfr_file:  # mapped lazily, after any fork
+            self._maps[shard_idx] = np.memmap(tfr_file, dtype=np.uint8, mode="r")
+            self._map_files[shard_idx] = tfr_file
+        return self._maps[shard_idx]
+
+    def shard_sizes(self):  # => [num_shards] int64 array of record counts
+        return np.bincount(self._index[:, 0], minlength=len(self.tfr_files)).astype(np.int64)
+
+    def record_lengths(self):  # => [num_records] int64 array of stored record sizes in bytes
+        return self._index[:, 2].copy()
+
+    def read(self, record_idx):  # => bytes of the record_idx'th record over all shards
+        shard_idx, offset, length = self._index[record_idx]
+        return self._get_map(shard_idx)[offset : offset + length].tobytes()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_maps"] = [None] * len(self.tfr_files)
+        state["_map_files"] = [None] * len(self.tfr_files)
+        return state
+
+# ----------------------------------------------------------------------------
+# Content-hash index.
+#
+# One fixed-width line per record, in record order: the SHA-1 of the stored
+# image bytes followed by an optional 64-bit perceptual hash ("-" if absent).
+# Fixed-width lines let an interrupted run truncate the file to the last
+# committed record.
+
+HASH_LINE_BYTES = 58
+
+
+def format_hash_line(digest, phash=None):
+    line = "%s %s\n" % (digest, phash if phash is not None else "-" * 16)
+    assert len(line) == HASH_LINE_BYTES
+    return line.encode("ascii")
+
+
+def load_hash_index(hash_file):  # => [(digest, phash or None), ...]
+    index = []
+    with open(hash_file, "r") as f:
+        for line in f:
+            digest, phash = line.split()
+            index.append((digest, None if phash == "-" * 16 else phash))
+    return index
+
+
+# ----------------------------------------------------------------------------
+# Dataset statistics.
+#
+# Written next to the shards by "dataset_tool.py create_stats":
+#
+#   num_images    Number of images the statistics cover (all of them).
+#   dataset       dataset_fingerprint() of the dataset the statistics were
+#                 computed for; a bank that no longer matches is ignored.
+#   shape         [channel, height, width] of the images.
+#   mean, std     Per-channel pixel mean and standard deviation in [0, 255].
+#   pixel_histogram  Per-channel counts of each of the 256 pixel values.
+#   record_bytes  Histogram of stored record sizes, {"edges", "counts"}.
+#   inception     None, or a dict describing a bank of Inception features:
+#                 "network" (URL of the feature network), "num_images"
+#                 (the bank covers the first num_images reals, in record
+#                 order), "file" and "mirror_file" (basenames of float32
+#                 .npy arrays for the images and their horizontal mirrors;
+#                 mirror_file may be None).
+
+
+def stats_filename(tfr_prefix):
+    return tfr_prefix + "-stats.json"
+
+
+def load_stats(tfrecord_dir):  # => dict or None
+    guess = sorted(glob.glob(os.path.join(tfrecord_dir, "*-stats.json")))
+    if not len(guess):
+        return None
+    with open(guess[0], "r") as f:
+        return json.load(f)
+
+
+def dataset_fingerprint(tfrecord_dir):  # => JSON-compatible dict identifying the stored records
+    manifest = load_manifest(tfrecord_dir)
+    if manifest is not None:
+        return dict(num_records=manifest["num_records"], shard_sha1=[shard.get("sha1") for shard in manifest["shards"]])
+    tfr_files = sorted(glob.glob(os.path.join(tfrecord_dir, "*.tfrecords")))[-1:]
+    return dict(files=[[os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f))] for f in tfr_files])
+
+
+def load_feature_bank(tfrecord_dir, network, mirror=False):  # => memory-mapped [num_images, dim] float32 or None
+    stats = load_stats(tfrecord_dir)
+    if stats is None or stats["inception"] is None or stats["inception"]["network"] != network:
+        return None
+    if stats.get("dataset") != dataset_fingerprint(tfrecord_dir):
+        print('Ignoring the feature bank in "%s": the dataset changed after create_stats' % tfrecord_dir)
+        return None
+    bank_file = stats["inception"]["mirror_file" if mirror else "file"]
+    if bank_file is None:
+        return None
+    return np.load(os.path.join(tfrecord_dir, bank_file), mmap_mode="r")
+
+
+# ----------------------------------------------------------------------------
+# Local read-through cache of shards.
+#
+# Shards on slow storage (e.g. a mounted Google Drive) are copied to a local
+# directory in a background thread the first time they are read, while the
+# reader keeps using the remote file. Copies are verified against the size and
+# SHA-1 recorded in the manifest and named after that hash, so they survive
+# restarts. The least recently used copies are evicted to stay within budget.
+
+
+class ShardCache:
+    def __init__(self, cache_dir, cache_mb):
+        self.cache_dir = cache_dir
+        self.cache_bytes = cache_mb << 20
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._recent = dict()  # dst_file => time of the last check
+        self._thread = None
+        self._closed = False
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        for tmp_file in glob.glob(os.path.join(self.cache_dir, "*.tmp")):
+            if time.time() - os.path.getmtime(tmp_file) > 600:
+                os.remove(tmp_file)  # left behind by an interrupted copy
+        self._evict(0)  # the budget may have shrunk since the last run
+
+    def _cache_filename(self, src_file, sha1):
+        key = sha1 if sha1 is not None else hashlib.sha1(os.path.abspath(src_file).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:16] + "-" + os.path.basename(src_file))
+
+    def resolve(self, src_file, num_bytes=None, sha1=None):  # => path of the local copy if complete, else src_file
+        dst_file = self._cache_filename(src_file, sha1)
+        if time.time() - self._recent.get(dst_file, 0) < 60:
+            return dst_file  # checked recently, spare the file system
+        if num_bytes is None:
+            num_bytes = os.path.getsize(src_file)
+        if os.path.isfile(dst_file) and os.path.getsize(dst_file) == num_bytes:
+            os.utime(dst_file)  # mark as recently used
+            self._recent[dst_file] = time.time()
+            return dst_file
+        with self._lock:
+            if not self._closed and dst_file not in self._pending and num_bytes <= self.cache_bytes:
+                self._pending.add(dst_file)
+                self._queue.put((src_file, dst_file, num_bytes, sha1))
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._copy_loop, daemon=True)
+                    self._thread.start()
+        return src_file
+
+    def _copy_loop(self):
+        while not self._closed:
+            item = self._queue.get()
+            if item is None:
+                break
+            src_file, dst_file, num_bytes, sha1 = item
+            try:
+                self._evict(num_bytes)
+                self._copy(src_file, dst_file, num_bytes, sha1)
+            except (IOError, OSError) as e:
+                print("Warning: could not cache %s: %s" % (src_file, e))
+            finally:
+                with self._lock:
+                    self._pending.discard(dst_file)
+
+    def _copy(self, src_file, dst_file, num_bytes, sha1):
+        tmp_file = "%s.%d-%d.tmp" % (dst_file, os.getpid(), threading.get_ident())
+        digest = hashlib.sha1()
+        try:
+            with open(src_file, "rb") as src, open(tmp_file, "wb") as dst:
+                for chunk in iter(lambda: src.read(8 << 20), b""):
+                    if self._closed:
+                        raise IOError("cache closed")
+                    digest.update(chunk)
+                    dst.write(chunk)
+            if os.path.getsize(tmp_file) != num_bytes:
+                raise IOError("size mismatch")
+            if sha1 is not None and digest.hexdigest() != sha1:
+                raise IOError("SHA-1 mismatch")
+            os.replace(tmp_file, dst_file)
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    def _evict(self, num_bytes):
+        cached = []
+        for cache_file in glob.glob(os.path.join(self.cache_dir, "*")):
+            if not cache_file.endswith(".tmp"):
+                cached.append((os.path.getmtime(cache_file), os.path.getsize(cache_file), cache_file))
+        total_bytes = sum(size for _mtime, size, _file in cached)
+        for _mtime, size, cache_file in sorted(cached):  # least recently used first
+            if total_bytes + num_bytes <= self.cache_bytes:
+                break
+            os.remove(cache_file)  # readers that still have it open keep working
+            self._recent.pop(cache_file, None)
+            total_bytes -= size
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+# ----------------------------------------------------------------------------
+# Labels stored next to the images.
+
+
+def find_label_file(data_dir, label_file=None):  # => path or None
+    if label_file is None:
+        guess = sorted(glob.glob(os.path.join(data_dir, "*.labels")))
+        if len(guess):
+            label_file = guess[0]
+    elif not os.path.isfile(label_file):
+        guess = os.path.join(data_dir, label_file)
+        if os.path.isfile(guess):
+            label_file = guess
+    return label_file
+
+# Float labels are stored dense as [num_images, label_size]. Integer labels
+# are stored compactly as int32 class indices [num_images], or as
+# [num_images, k] lists of class indices padded with -1, and are only expanded
+# to one-hot / multi-hot vectors for the current minibatch.
+
+
+def load_labels(label_file, max_label_size, label_size=None):  # => stored labels or None, label_size
+    assert max_label_size == "full" or max_label_size >= 0
+    if label_file is None or max_label_size == 0:
+        return None, 0
+    labels = np.load(label_file)
+    if np.issubdtype(labels.dtype, np.integer):
+        assert labels.ndim in [1, 2]
+        labels = labels.astype(np.int32)
+        if label_size is None:
+            label_size = int(labels.max()) + 1
+    else:
+        assert labels.ndim == 2
+        label_size = labels.shape[1]
+    if max_label_size != "full" and label_size > max_label_size:
+        label_size = max_label_size
+        if labels.dtype != np.int32:
+            labels = labels[:, :label_size]
+    return labels, int(label_size)
+
+def expand_labels_np(labels, label_size):  # => [minibatch, label_size] float32
+    if labels.dtype != np.int32:
+        return labels.astype(np.float32)
+    indices = labels.reshape(labels.shape[0], -1)
+    indices = np.where((indices >= 0) & (indices < label_size), indices, label_size)
+    dense = np.zeros([labels.shape[0], label_size + 1], np.float32)  # last column collects padding
+    dense[np.arange(labels.shape[0])[:, np.newaxis], indices] = 1.0
+    return dense[:, :label_size]
+
+# ----------------------------------------------------------------------------
+# Minimal parser for the tf.train.Example protos written by dataset_tool.py.
+
+
+def _read_varint(buf, pos):  # => value, new pos
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _iter_fields(buf):  # => (field number, wire type, value) for each field of a message
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:  # varint
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:  # 64-bit
+            value, pos = buf[pos : pos + 8], pos + 8
+        elif wire_type == 2:  # length-delimited
+            length, pos = _read_varint(buf, pos)
+            value, pos = buf[pos : pos + length], pos + length
+        elif wire_type == 5:  # 32-bit
+            value, pos = buf[pos : pos + 4], pos + 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wire_type)
+        yield field, wire_type, value
+
+
+def _parse_feature(buf):  # => list of bytes, floats or ints
+    for kind, _wire_type, list_buf in _iter_fields(buf):
+        values = []
+        for field, wire_type, value in _iter_fields(list_buf):
+            if field != 1:
+                continue
+            if kind == 1:  # bytes_list
+                values.append(bytes(value))
+            elif kind == 2:  # float_list
+                values += np.frombuffer(value, "<f4").tolist()  # packed or not, same bytes
+            elif kind == 3:  # int64_list
+                if wire_type == 2:  # packed
+                    pos = 0
+                    while pos < len(value):
+                        x, pos = _read_varint(value, pos)
+                        values.append(x - (1 << 64) if x >= 1 << 63 else x)
+                else:
+                    values.append(value - (1 << 64) if value >= 1 << 63 else value)
+        return values
+    return []
+
+
+def parse_example(record):  # => {feature name: list of values}
+    features = dict()
+    for field, _wire_type, features_buf in _iter_fields(memoryview(record)):
+        if field != 1:  # Example.features
+            continue
+        for field, _wire_type, entry in _iter_fields(features_buf):  # Features.feature map entries
+            if field != 1:
+                continue
+            name, values = None, []
+            for key, _wire_type, value in _iter_fields(entry):
+                if key == 1:
+                    name = bytes(value).decode("utf-8")
+                elif key == 2:
+                    values = _parse_feature(value)
+            features[name] = values
+    return features
+
+
+# ----------------------------------------------------------------------------
+# Per-record codecs for raw-pixel ("data") records. All are lossless:
+#
+#   none          The uint8 pixels as is.
+#   zlib          zlib stream of the pixels; decoded in-graph by TF.
+#   png           PNG of the image; decoded in-graph by TF.
+#   webp          Lossless WebP; smallest, decoded through PIL.
+#   lz4           LZ4 block of the pixels; fastest to decode, needs the
+#                 optional lz4 package, decoded through a py_func in TF.
+
+CODECS = ["none", "zlib", "png", "webp", "lz4"]
+
+
+def encode_pixels(img, codec):  # [channel, height, width] uint8 => bytes
+    if codec == "none":
+        return img.tobytes()
+    if codec == "zlib":
+        return zlib.compress(img.tobytes())
+    if codec == "lz4":
+        import lz4.block  # optional dependency
+        return lz4.block.compress(img.tobytes())
+    import PIL.Image  # only needed for image codecs
+
+    pil_img = PIL.Image.fromarray(img[0] if img.shape[0] == 1 else img.transpose(1, 2, 0))
+    buf = io.BytesIO()
+    if codec == "png":
+        pil_img.save(buf, format="PNG", compress_level=6)
+    elif codec == "webp":
+        pil_img.save(buf, format="WEBP", lossless=True, quality=50, method=2)
+    else:
+        raise ValueError("Unknown codec: %s" % codec)
+    return buf.getvalue()
+
+
+def decode_pixels(data, shape, codec):  # => [channel, height, width] uint8 array
+    if codec == "none":
+        return np.frombuffer(data, np.uint8).reshape(shape)
+    if codec == "zlib":
+        return np.frombuffer(zlib.decompress(data), np.uint8).reshape(shape)
+    if codec == "lz4":
+        import lz4.block  # optional dependency
+        return np.frombuffer(lz4.block.decompress(data), np.uint8).reshape(shape)
+    import PIL.Image  # only needed for image codecs
+
+    img = PIL.Image.open(io.BytesIO(data))
+    img = np.asarray(img.convert("L" if shape[0] == 1 else "RGB"))  # WebP stores grayscale as RGB
+    if img.ndim == 3:
+        img = img.transpose(2, 0, 1)  # HWC => CHW
+    return img.reshape(shape)
+
+
+def decode_record(record, decode_scale=1, codec="none"):  # => [channel, height, width] uint8 array
+    features = parse_example(record)
+    shape = features["shape"]
+    if "data" in features:
+        img = decode_pixels(features["data"][0], shape, codec)
+        if decode_scale > 1:
+            c, h, w = img.shape
+            img = img.reshape(c, h // decode_scale, decode_scale, w // decode_scale, decode_scale).mean((2, 4))
+            img = np.rint(img).astype(np.uint8)
+        return img
+    import PIL.Image  # only needed for encoded images
+
+    img = PIL.Image.open(io.BytesIO(features["img"][0]))
+    if decode_scale > 1:
+        size = (img.size[0] // decode_scale, img.size[1] // decode_scale)
+        img.draft(img.mode, size)  # JPEG: scale down while decoding
+        if img.size != size:
+            img = img.resize(size, PIL.Image.BOX)
+    img = np.asarray(img)
+    if img.ndim == 2:
+        return img[np.newaxis]  # HW => CHW
+    return img.transpose(2, 0, 1)  # HWC => CHW
+
+# ----------------------------------------------------------------------------
+# Reads a dataset written by dataset_tool.py into NumPy minibatches without
+# TensorFlow. Records are read through memory maps and decoded by a pool of
+# worker processes, a few minibatches ahead of the consumer.
+
+def open_record_reader(tfrecord_dir):  # => RecordReader over all images, manifest or None
+    manifest = load_manifest(tfrecord_dir)
+    if manifest is not None:
+        tfr_files = get_shard_paths(tfrecord_dir, manifest)
+    else:
+        tfr_files = sorted(glob.glob(os.path.join(tfrecord_dir, "*.tfrecords")))[-1:]  # highest resolution
+    assert len(tfr_files) >= 1
+    return RecordReader(tfr_files), manifest
+
+
+_worker_reader = None
+
+
+def _init_worker_reader(reader):
+    global _worker_reader  # pylint: disable=global-statement
+    _worker_reader = reader
+
+
+def _decode_indices(args):  # => [len(indices), channel, height, width] uint8 array
+    indices, decode_scale, codec = args
+    return np.stack([decode_record(_worker_reader.read(idx), decode_scale, codec) for idx in indices])
+
+
+class NumpyReader:
+    def __init__(
+        self,
+        tfrecord_dir,  # Directory containing the dataset.
+        label_file=None,  # Relative path of the labels file, None = autodetect.
+        max_label_size=0,  # 0 = no labels, 'full' = full labels, <int> = N first label components.
+        decode_scale=1,  # Return images downscaled by 1, 2, 4 or 8.
+        num_workers=None,  # Number of decode processes, None = one per CPU, 0 = decode in the calling process.
+    ):
+        self.tfrecord_dir = tfrecord_dir
+        self._reader, self.manifest = open_record_reader(tfrecord_dir)
+        label_size = None
+        if self.manifest is not None and label_file is None and self.manifest["label_file"] is not None:
+            label_file = os.path.join(tfrecord_dir, self.manifest["label_file"])
+            label_size = self.manifest["label_size"]
+        self.num_images = len(self._reader)
+        self.codec = self.manifest.get("codec", "none") if self.manifest is not None else "none"
+        first = decode_record(self._reader.read(0), decode_scale, self.codec)
+        self.shape = list(first.shape)
+        self.dtype = "uint8"
+        self.dynamic_range = [0, 255]
+        self.decode_scale = decode_scale
+        self.num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count()
+        self.label_file = find_label_file(tfrecord_dir, label_file)
+        self._np_labels, self.label_size = load_labels(self.label_file, max_label_size, label_size)
+        self.label_dtype = "float32"
+
+    def get_labels_np(self, begin, end):  # => [end - begin, label_size] float32
+        if self.label_size > 0:
+            return expand_labels_np(self._np_labels[begin:end], self.label_size)
+        return np.zeros([end - begin, 0], self.label_dtype)
+
+    def iterate_minibatches(self, minibatch_size, repeat=False, layout="NCHW"):  # => images, labels
+        assert layout in ["NCHW", "NHWC"]
+        def ranges():
+            # With repeat, minibatches run across the end of the dataset so that every one is full.
+            for begin in itertools.count(0, minibatch_size):
+                if not repeat and begin >= self.num_images:
+                    return
+                end = begin + minibatch_size if repeat else min(begin + minibatch_size, self.num_images)
+                yield np.arange(begin, end) % self.num_images, self.decode_scale, self.codec
+
+        def finish(task, images):
+            if layout == "NHWC":
+                images = images.transpose(0, 2, 3, 1)
+            if self.label_size > 0:
+                return images, expand_labels_np(self._np_labels[task[0]], self.label_size)
+            return images, np.zeros([len(task[0]), 0], self.label_dtype)
+
+        if self.num_workers <= 0:
+            _init_worker_reader(self._reader)
+            for task in ranges():
+                yield finish(task, _decode_indices(task))
+            return
+        with multiprocessing.Pool(self.num_workers, _init_worker_reader, (self._reader,)) as pool:
+            pending = collections.deque()
+            for task in ranges():
+                pending.append((task, pool.apply_async(_decode_indices, (task,))))
+                if len(pending) >= self.num_workers * 2:  # bounded read-ahead
+                    task, result = pending.popleft()
+                    yield finish(task, result.get())
+            while pending:
+                task, result = pending.popleft()
+                yield finish(task, result.get())
+
+# ----------------------------------------------------------------------------
@@ -338,6 +338,9 @@ def training_loop(
                 autosummary('Timing/sec_per_kimg', tick_time / tick_kimg),
                 autosummary('Timing/maintenance_sec', maintenance_time),
                 autosummary('Resources/peak_gpu_mem_gb', peak_gpu_mem_op.eval() / 2**30)))
+            print('data %-9.1f img/s (input pipeline) train %-9.1f img/s' % (
+                autosummary('Timing/dataset_img_per_sec', training_set.get_images_per_sec()),
+                autosummary('Timing/train_img_per_sec', tick_kimg * 1000.0 / max(tick_time, 1e-6))))
             autosummary('Timing/total_hours', total_time / (60.0 * 60.0))
             autosummary('Timing/total_days', total_time / (24.0 * 60.0 * 60.0))
 